@@ -1,9 +1,36 @@
 
-from collections import defaultdict
-import re
+from bisect import bisect_right
+from collections import defaultdict, deque, namedtuple
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from operator import itemgetter
+from typing import Dict, List, Optional, Union
+import concurrent.futures
+import copy
+import cProfile
+import csv
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
+import queue
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
 import argparse
 import logging
+try:
+    import numpy
+except ImportError:
+    numpy = None
 logging.basicConfig(
     format="[%(levelname)s] %(message)s",
 )
@@ -11,6 +38,12 @@ logging.basicConfig(
 
 logger = logging.getLogger("easygen")
 
+WRITE_BUFFER_SIZE = 1 << 16
+
+# Bump when a change makes the same chart and options convert differently,
+# so --batch manifests don't skip the charts converted before it
+CONVERTER_VERSION = 2
+
 
 def parse_args(argument_parser_class=argparse.ArgumentParser):
     # Positional arg: filename
@@ -46,23 +79,642 @@ def parse_args(argument_parser_class=argparse.ArgumentParser):
 
     parser.add_argument('--force', help='If this is given, replace existing parts', action="store_true")
 
+    parser.add_argument(
+        '--no_manifest', help='Convert every file in --batch, even if it has not changed since the last run',
+        action="store_true"
+    )
+
+    parser.add_argument(
+        '--rules', help='JSON file overriding the difficulty rules (see DIFFICULTY_RULES in easygen.py)',
+    )
+
+    parser.add_argument(
+        '--numpy', help='Reduce notes with the vectorized NumPy engine (needs numpy installed)',
+        action="store_true"
+    )
+
+    parser.add_argument(
+        '--profile', help='Log per phase timings and counters for each file', action="store_true"
+    )
+    parser.add_argument('--profile_report', help='Write per phase timings and counters of all files to this JSON file')
+    parser.add_argument('--cprofile', help='Write cProfile stats of the run to this file')
+
+    parser.add_argument(
+        '--jobs', help='Number of files to convert in parallel (0 = one per CPU)',
+        type=int, default=1
+    )
+    parser.add_argument(
+        '--section_jobs',
+        help='Number of Expert parts of a chart to reduce in parallel (0 = one per CPU). Not used with --jobs',
+        type=int, default=1
+    )
+    parser.add_argument(
+        '--low_memory',
+        help='Keep only one generated part in memory at a time, for very large charts. --section_jobs is ignored with this',
+        action="store_true"
+    )
+    parser.add_argument(
+        '--analyze',
+        help="Don't convert anything, write statistics of the charts to this .csv or .json report",
+    )
+    parser.add_argument(
+        '--watch', help='After converting, keep converting charts again when they are saved',
+        action="store_true"
+    )
+    parser.add_argument(
+        '--yes', help="Don't ask for confirmation, start converting files as soon as they are found",
+        action="store_true"
+    )
+
     parser.add_argument('-v', '--verbose', help='Verbose logs', action="store_true")
     return parser.parse_args()
 
 
+class TempoMap():
+    # Compiled view of the sync track: sorted tick arrays for bisect lookups
+    # and the wall-clock seconds at the start of every tempo segment, so
+    # tick -> bpm/ts/seconds conversions are O(log n) and span tempo changes.
+
+    def __init__(self, resolution, bpm_for_ms, ts_for_ms):
+        self.resolution = resolution
+        bpm_for_ms = sorted(bpm_for_ms, key=lambda item: item[1])
+        ts_for_ms = sorted(ts_for_ms, key=lambda item: item[1])
+        self.bpms = [bpm for bpm, _ in bpm_for_ms]
+        self.bpm_ticks = [line_ms for _, line_ms in bpm_for_ms]
+        self.ts_values = [ts for ts, _ in ts_for_ms]
+        self.ts_ticks = [line_ms for _, line_ms in ts_for_ms]
+
+        # Prefix sum of segment durations, in seconds
+        self.bpm_seconds = []
+        seconds = 0.0
+        for index, line_ms in enumerate(self.bpm_ticks):
+            if index > 0:
+                seconds += self._segment_seconds(index - 1, line_ms - self.bpm_ticks[index - 1])
+            self.bpm_seconds.append(seconds)
+
+    def _segment_seconds(self, index, ticks):
+        bpm = self.bpms[index]
+        if not bpm:
+            return 0.0
+        # beats = ticks / resolution, minutes = beats / bpm
+        return ticks / self.resolution / bpm * 60
+
+    @staticmethod
+    def _index(ticks, ms):
+        # Last event at or before ms. Ticks before the first event use the
+        # first event.
+        index = bisect_right(ticks, ms) - 1
+        if index < 0:
+            return 0
+        return index
+
+    def bpm_at(self, ms):
+        if not self.bpm_ticks:
+            return None
+        index = self._index(self.bpm_ticks, ms)
+        return self.bpms[index], self.bpm_ticks[index]
+
+    def ts_at(self, ms):
+        if not self.ts_ticks:
+            return None
+        index = self._index(self.ts_ticks, ms)
+        return self.ts_values[index], self.ts_ticks[index]
+
+    def seconds_at(self, ms):
+        if not self.bpm_ticks:
+            return None
+        index = self._index(self.bpm_ticks, ms)
+        return self.bpm_seconds[index] + self._segment_seconds(index, ms - self.bpm_ticks[index])
+
+    def iter_seconds(self, ticks):
+        # seconds_at for ascending ticks, walking the tempo segments
+        # instead of searching them
+        bpm_ticks = self.bpm_ticks
+        last = len(bpm_ticks) - 1
+        index = 0
+        for ms in ticks:
+            while index < last and bpm_ticks[index + 1] <= ms:
+                index += 1
+            yield self.bpm_seconds[index] + self._segment_seconds(index, ms - bpm_ticks[index])
+
+    def real_time_diff(self, ms, prev_ms):
+        # Milliseconds between two ticks. Within a single tempo segment skip
+        # the prefix sums to keep the result exact.
+        if not self.bpm_ticks:
+            return None
+        index = self._index(self.bpm_ticks, ms)
+        if index == self._index(self.bpm_ticks, prev_ms):
+            return self._segment_seconds(index, ms - prev_ms) * 1000
+        return (self.seconds_at(ms) - self.seconds_at(prev_ms)) * 1000
+
+
+class ChartSection():
+    def __init__(self, name, buffer=None, start=0, end=0, raw_start=None, raw_end=None):
+        self.name = name
+        # Byte range of the lines between { and } in buffer, for sections
+        # found by index_chart. Their events are tokenized on first use.
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        # Byte range of the whole section from [ to }, None if the section
+        # can't be copied as it is
+        self.raw_start = raw_start
+        self.raw_end = raw_end
+        self._events = None if buffer is not None else []
+
+    @property
+    def events(self):
+        # (key, value) pairs. Keys of tick events are ints, keys of lines
+        # without a '=' are None and the value holds the whole line.
+        if self._events is None:
+            text = self.buffer[self.start:self.end].decode(CHART_ENCODING, CHART_ENCODING_ERRORS)
+            self._events = tokenize_events(text.splitlines())
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self._events = events
+
+    def detach(self):
+        # A copy that doesn't reference the chart buffer, for sending to
+        # another process. Events that haven't been tokenized yet are sent
+        # as bytes and tokenized there.
+        if self._events is not None:
+            section = ChartSection(self.name)
+            section.events = self._events
+            return section
+        return ChartSection(self.name, bytes(self.buffer[self.start:self.end]), 0, self.end - self.start)
+
+
+class Profile():
+    # Per phase timings and counters of a single file, for --profile
+    PHASES = ('read', 'sync_track', 'doublekick', 'reduce', 'sort', 'write')
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - started
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def merge(self, profile):
+        # Add the timings and counters of a profile dict from another process
+        for phase, seconds in profile['seconds'].items():
+            self.timings[phase] += seconds
+        for name, value in profile['counters'].items():
+            self.counters[name] += value
+
+    def as_dict(self):
+        return {
+            'filename': self.filename,
+            'seconds': {phase: self.timings.get(phase, 0.0) for phase in self.PHASES},
+            'counters': dict(self.counters),
+        }
+
+    def log(self):
+        logger.info("Profile: %s", ', '.join(
+            '{} {:.4f}s'.format(phase, self.timings.get(phase, 0.0)) for phase in self.PHASES
+        ))
+        logger.info("Counters: %s", ', '.join(
+            '{} {}'.format(name, value) for name, value in sorted(self.counters.items())
+        ))
+
+
+class Note(namedtuple('Note', ['tick', 'color', 'length'])):
+    # A parsed 'N color length' event. Only formatted back when writing.
+    __slots__ = ()
+
+    def __str__(self):
+        return 'N {} {}'.format(self.color, self.length)
+
+
+# A tick of an Expert part, classified once for all difficulties
+Tick = namedtuple('Tick', [
+    'ms', 'beat_number', 'on_beat', 'off_beat', 'half_beat', 'notes', 'others',
+    'ghost_note', 'cymbal_notes', 'accent_notes',
+])
+
+# Drum notes that only modify other notes: cymbals, accents and ghosts
+DRUM_MODIFIERS = (66, 67, 68, 34, 35, 36, 40)
+# Same for the other instruments: forced and tap notes
+SINGLE_MODIFIERS = (5, 6)
+
+
+class Chart():
+    def __init__(self, buffer=None):
+        self.header = []  # Lines before the first section
+        self.sections = []
+        self.line_count = 0
+        # The raw chart for charts from index_chart, maybe an mmap
+        self.buffer = buffer
+        # Line ending and final newline of the source, kept in the output
+        self.newline = '\n'
+        self.final_newline = False
+        # Time read_ahead spent reading the chart in the background
+        self.read_seconds = 0.0
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+def tokenize_chart(lines):
+    # Single pass over the input lines, producing a Chart
+    chart = Chart()
+    section = None
+    in_body = False
+    line_number = -1
+    for line_number, line in enumerate(lines):
+        line = line.strip()
+        if line_number == 0:
+            line = line.replace('\ufeff', '')
+        if not line:
+            continue
+        if in_body:
+            if line == '}':
+                section = None
+                in_body = False
+                continue
+            key, separator, value = line.partition('=')
+            if not separator:
+                section.events.append((None, line))
+                continue
+            key = key.strip()
+            if key.isdigit():
+                key = int(key)
+            section.events.append((key, value.strip()))
+        elif line[0] == '[' and line[-1] == ']':
+            section = ChartSection(line)
+            chart.sections.append(section)
+        elif line == '{' and section is not None:
+            in_body = True
+        elif section is None:
+            chart.header.append(line)
+    chart.line_count = line_number + 1
+    return chart
+
+
+def tokenize_events(lines):
+    # Tokenize the lines inside a section's { }
+    events = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        key, separator, value = line.partition('=')
+        if not separator:
+            events.append((None, line))
+            continue
+        key = key.strip()
+        if key.isdigit():
+            key = int(key)
+        events.append((key, value.strip()))
+    return events
+
+
+CHART_ENCODING = 'utf-8'
+# Bytes that aren't valid UTF-8 are passed through as they are
+CHART_ENCODING_ERRORS = 'surrogateescape'
+
+SECTION_HEADER_RE = re.compile(rb'^(?:\xef\xbb\xbf)*[ \t\r\f\v]*(\[[^\r\n]*\])[ \t\r\f\v]*$', re.MULTILINE)
+SECTION_OPEN_RE = re.compile(rb'\s*\{[ \t\r\f\v]*(?:\n|\Z)')
+SECTION_CLOSE_RE = re.compile(rb'^[ \t\f\v]*\}[ \t\f\v]*(?=\r?$)', re.MULTILINE)
+
+COUNT_CHUNK_SIZE = 1 << 20
+
+
+def count_lines(buffer):
+    # bytes.count in chunks, mmap has no count()
+    count = 0
+    for position in range(0, len(buffer), COUNT_CHUNK_SIZE):
+        count += buffer[position:position + COUNT_CHUNK_SIZE].count(b'\n')
+    if buffer and buffer[-1:] != b'\n':
+        count += 1
+    return count
+
+
+def index_chart(buffer):
+    # Find the byte range of every section in buffer (bytes or mmap) with
+    # a single scan. Nothing is decoded here, sections are tokenized when
+    # their events are first used.
+    chart = Chart(buffer)
+    position = 0
+    while True:
+        header = SECTION_HEADER_RE.search(buffer, position)
+        if header is None:
+            break
+        name = header.group(1).decode(CHART_ENCODING, CHART_ENCODING_ERRORS)
+        opening = SECTION_OPEN_RE.match(buffer, header.end())
+        if opening is None:
+            # A section without a body
+            chart.sections.append(ChartSection(name, buffer, header.end(), header.end()))
+            position = header.end()
+            continue
+        closing = SECTION_CLOSE_RE.search(buffer, opening.end())
+        if closing is None:
+            # Unterminated, the writer closes it
+            chart.sections.append(ChartSection(name, buffer, opening.end(), len(buffer)))
+            break
+        chart.sections.append(ChartSection(
+            name, buffer, opening.end(), closing.start(), header.start(1), closing.end()
+        ))
+        position = closing.end()
+    chart.line_count = count_lines(buffer)
+    first_newline = buffer.find(b'\n')
+    if first_newline > 0 and buffer[first_newline - 1:first_newline] == b'\r':
+        chart.newline = '\r\n'
+    chart.final_newline = buffer[-1:] == b'\n'
+    return chart
+
+
+def read_chart(filename):
+    # Map the file into memory and index it. Call close() on the chart
+    # when done with it.
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return index_chart(b'')
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return index_chart(buffer)
+    except BaseException:
+        buffer.close()
+        raise
+
+
+def ordered_events(events):
+    # Tick events are almost always in order already, so instead of sorting
+    # split them into ascending runs and merge those. Input in order is a
+    # single run and is returned as is. Keyless lines stay with the tick
+    # before them, non tick sections (e.g. [Song]) are never reordered.
+    runs = []
+    run = []
+    tick = None
+    for event in events:
+        key = event[0]
+        if isinstance(key, int):
+            if tick is not None and key < tick:
+                runs.append(run)
+                run = []
+            tick = key
+        elif key is not None:
+            return events
+        run.append((tick or 0, event))
+    if not runs:
+        return events
+    runs.append(run)
+    return [event for _, event in heapq.merge(*runs, key=itemgetter(0))]
+
+
+def count_notes(events):
+    # Notes of a part, parsed or still as 'N color length' lines (an
+    # Expert part rewritten by --doublekick has both)
+    return sum(
+        1 for _, value in events
+        if isinstance(value, Note) or (isinstance(value, str) and value.startswith('N '))
+    )
+
+
+def format_section(events):
+    yield '{'
+    for key, value in events:
+        if key is None:
+            yield value
+        else:
+            yield '{} = {}'.format(key, value)
+    yield '}'
+
+
+# How each difficulty is reduced from Expert, per instrument. Parts with
+# 'Drums' in the name use the drums rules, everything else the single rules.
+#   gap: a note this many beats (in resolution units) after the previous
+#        note is treated as on beat, unless it's an off beat
+#   gap_inclusive: also treat a gap of exactly `gap` beats as on beat
+#   half_beats: half beats count as on beat
+#   on_beat_notes / off_beat_notes: max chord size (None = no limit)
+#   bass: None, 'first_beat' (bass alone, only on the first beat) or
+#         'with_note' (bass and on_beat_notes other notes)
+#   off_beat_bass: 'always', 'never' or 'small_chords' (only in chords of
+#                  2 notes or less)
+#   ghost_off_grid: keep ghost notes between on and off beats
+#   color_map: color -> color
+#   max_nps: at most this many chords (a single note counts as a chord) in
+#            any one second of real time, None = no limit. Off grid chords
+#            are dropped first, then off beats, then on beats.
+DIFFICULTY_RULES = {
+    'single': {
+        'easy': {
+            'gap': 3,
+            'on_beat_notes': 1,
+            'off_beat_notes': 0,
+            'color_map': {7: 0, 4: 0, 3: 1},
+            'max_nps': 3,
+        },
+        'medium': {
+            'gap': 2,
+            'on_beat_notes': 2,
+            'off_beat_notes': 2,
+            'color_map': {7: 0, 4: 0},
+            'max_nps': 5,
+        },
+        'hard': {
+            'gap': 1,
+            'gap_inclusive': True,
+            'half_beats': True,
+            'on_beat_notes': None,
+            'off_beat_notes': None,
+            'max_nps': 8,
+        },
+    },
+    'drums': {
+        'easy': {
+            'gap': 3,
+            'bass': 'first_beat',
+            'on_beat_notes': 1,
+            'off_beat_notes': 0,
+            'color_map': {3: 2, 4: 2},
+            'max_nps': 4,
+        },
+        'medium': {
+            'gap': 2,
+            'bass': 'first_beat',
+            'on_beat_notes': 1,
+            'off_beat_notes': 2,
+            'off_beat_bass': 'never',
+            'ghost_off_grid': False,
+            'color_map': {4: 3},
+            'max_nps': 6,
+        },
+        'hard': {
+            'gap': 1,
+            'bass': 'with_note',
+            'on_beat_notes': 1,
+            'off_beat_notes': 2,
+            'off_beat_bass': 'small_chords',
+            'max_nps': 8,
+        },
+    },
+}
+
+RULE_DEFAULTS = {
+    'gap_inclusive': False,
+    'half_beats': False,
+    'bass': None,
+    'off_beat_bass': 'always',
+    'ghost_off_grid': True,
+    'color_map': {},
+    'max_nps': None,
+}
+
+# Rules without a default, every difficulty has to give them
+REQUIRED_RULES = ('gap', 'on_beat_notes', 'off_beat_notes')
+
+RULE_CHOICES = {
+    'bass': (None, 'first_beat', 'with_note'),
+    'off_beat_bass': ('always', 'never', 'small_chords'),
+}
+
+
+def check_rule(key, value):
+    # Raises ValueError for a rule that doesn't exist or an invalid value
+    if key not in RULE_DEFAULTS and key not in REQUIRED_RULES:
+        raise ValueError("unknown rule {!r}".format(key))
+    if key in RULE_CHOICES:
+        valid = value in RULE_CHOICES[key]
+    elif key in ('gap_inclusive', 'half_beats', 'ghost_off_grid'):
+        valid = isinstance(value, bool)
+    elif key == 'color_map':
+        valid = isinstance(value, dict) and all(
+            isinstance(color, int) and isinstance(new_color, int) and color >= 0 and new_color >= 0
+            for color, new_color in value.items()
+        )
+    elif key in ('on_beat_notes', 'off_beat_notes'):
+        valid = value is None or (isinstance(value, int) and not isinstance(value, bool) and value >= 0)
+    else:
+        # gap, max_nps
+        valid = (
+            (value is None and key == 'max_nps')
+            or (isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0)
+        )
+    if not valid:
+        raise ValueError("invalid value {!r} for {}".format(value, key))
+
+
+def load_rules(overrides=None):
+    # DIFFICULTY_RULES, with overrides on top. Overrides are a dict of the
+    # same shape or the filename of a JSON file containing one.
+    rules = {
+        instrument: {diff: dict(spec) for diff, spec in diffs.items()}
+        for instrument, diffs in DIFFICULTY_RULES.items()
+    }
+    if not overrides:
+        return rules
+    source = 'rules'
+    if not isinstance(overrides, dict):
+        source = overrides
+        with open(overrides, 'r') as f:
+            overrides = json.load(f)
+    for instrument, diffs in overrides.items():
+        for diff, spec in diffs.items():
+            if instrument not in rules or diff not in rules[instrument]:
+                raise ValueError("Unknown rule {}.{} in {}".format(instrument, diff, source))
+            spec = dict(spec)
+            try:
+                if isinstance(spec.get('color_map'), dict):
+                    # JSON keys are always strings. The colors given are
+                    # remapped on top of the default map, map a color to
+                    # itself to keep it.
+                    color_map = dict(rules[instrument][diff].get('color_map', {}))
+                    color_map.update(
+                        (int(color), int(new_color)) for color, new_color in spec['color_map'].items()
+                    )
+                    spec['color_map'] = color_map
+                for key, value in spec.items():
+                    check_rule(key, value)
+            except (TypeError, ValueError) as e:
+                raise ValueError("Invalid rule {}.{} in {}: {}".format(instrument, diff, source, e))
+            rules[instrument][diff].update(spec)
+    return rules
+
+
+class DifficultyRules():
+    # One entry of DIFFICULTY_RULES compiled for a chart resolution
+    __slots__ = (
+        'gap', 'gap_inclusive', 'half_beats', 'on_beat_notes', 'off_beat_notes',
+        'bass', 'off_beat_bass', 'ghost_off_grid', 'color_table', 'modifiers', 'max_nps',
+    )
+
+    def __init__(self, spec, resolution, modifiers=False):
+        spec = dict(RULE_DEFAULTS, **spec)
+        self.gap = spec['gap'] * resolution
+        self.gap_inclusive = spec['gap_inclusive']
+        self.half_beats = spec['half_beats']
+        self.on_beat_notes = spec['on_beat_notes']
+        self.off_beat_notes = spec['off_beat_notes']
+        self.bass = spec['bass']
+        self.off_beat_bass = spec['off_beat_bass']
+        self.ghost_off_grid = spec['ghost_off_grid']
+        self.max_nps = spec['max_nps']
+        self.modifiers = modifiers
+        # color -> color, colors past the end are kept as is
+        self.color_table = list(range(max(spec['color_map'], default=-1) + 1))
+        for color, new_color in spec['color_map'].items():
+            self.color_table[color] = new_color
+
+    def map_color(self, color):
+        if color < len(self.color_table):
+            return self.color_table[color]
+        return color
+
+
+def compile_rules(rules, resolution):
+    return {
+        instrument: {
+            diff: DifficultyRules(spec, resolution, modifiers=(instrument == 'drums'))
+            for diff, spec in diffs.items()
+        }
+        for instrument, diffs in rules.items()
+    }
+
+
 class Parser():
 
-    def __init__(self, options):
+    def __init__(self, options, profile=None):
+        self.options = options
+        self.profile = profile or Profile()
         self.sync_track = []
         self.resolution = None
         self.new_parts = {}
-        self.lines = []
+        self.replaced_parts = []
+        self.skipped_parts = []
+        self.chart = None
         self.ts_for_ms = []  # Always x/4
         self.bpm_for_ms = []
+        self.tempo_map = TempoMap(None, [], [])
 
         self.force_replace_parts = bool(options.force)
         self.bpm_multiplier = options.bpm_multiplier
         self.doublekick = options.doublekick
+        self.rules = load_rules(getattr(options, 'rules', None))
+        self.compiled_rules = None
+        self.numpy_engine = bool(getattr(options, 'numpy', False))
+        if self.numpy_engine and numpy is None:
+            logger.warning("numpy is not installed, using the default engine")
+            self.numpy_engine = False
+        # With --low_memory new parts are written to a temporary file as
+        # soon as they're generated, see spill_new_parts
+        self.low_memory = bool(getattr(options, 'low_memory', False))
+        self.spill = None
+        self.spill_buffer = None
+        self.spilled_parts = {}  # partname -> byte ranges in spill
 
         if options.easy or options.medium or options.hard:
             self.parts_to_generate = []
@@ -83,22 +735,10 @@ class Parser():
         self._log_extra_bpm_multiplier_run = True
 
     def get_ts_for_ms(self, ms):
-        ms = int(ms)
-        prev_ret = None
-        for ts, line_ms in self.ts_for_ms:
-            if prev_ret and line_ms > ms:
-                return prev_ret
-            prev_ret = ts, line_ms
-        return prev_ret
+        return self.tempo_map.ts_at(int(ms))
 
     def get_bpm_for_ms(self, ms):
-        ms = int(ms)
-        prev_ret = None
-        for bpm, line_ms in self.bpm_for_ms:
-            if prev_ret and line_ms > ms:
-                return prev_ret
-            prev_ret = bpm, line_ms
-        return prev_ret
+        return self.tempo_map.bpm_at(int(ms))
 
     def get_effective_bpm(self, ms):
         bpm, bpm_ms = self.get_bpm_for_ms(ms)
@@ -110,7 +750,11 @@ class Parser():
 
     def handle_sync_track(self):
         for line in self.sync_track:
-            line_ms = int(line[0])
+            try:
+                line_ms = int(line[0])
+            except ValueError:
+                logger.error("Error parsing sync track line %s = %s", line[0], line[1])
+                continue
             if 'B ' in line[1]:
                 line_bpm = int(line[1].replace('B ', '').strip()) / 1000.0
                 self.bpm_for_ms.append((
@@ -122,22 +766,16 @@ class Parser():
                     line_ts, line_ms
                 ))
         logger.debug("ts_for_ms: %s", self.ts_for_ms)
-
+        self.tempo_map = TempoMap(self.resolution, self.bpm_for_ms, self.ts_for_ms)
 
     def ms_to_real_time_diff(self, ms, prev_ms):
         # Convert ms values to real time diff
         # To make them comparable in songs that have different bpm
-        # parts
-        bpm, bpm_ms = self.get_bpm_for_ms(prev_ms)
-        if not bpm:
+        # parts. Tempo changes between prev_ms and ms are accounted for.
+        diff = self.tempo_map.real_time_diff(ms, prev_ms)
+        if diff is None:
             return 99999
-        ms_diff = ms - prev_ms
-        beats = ms_diff / (self.resolution)
-        # beats tells us how many beats the diff is
-        # bpm = beats/minute
-        # minutes = beats/bpm
-        minutes = beats / bpm
-        return minutes * 60000
+        return diff
 
     def get_beat(self, milliseconds):
         # return number (0-3) or more on different time signatures
@@ -152,458 +790,806 @@ class Parser():
         beat = delta_ms / resolution
         return beat % ts
 
-    def notes_to_diff_single(self, diff, ms, notes, ms_delta_around=0):
+    def get_rules(self, part):
+        if self.compiled_rules is None:
+            self.compiled_rules = compile_rules(self.rules, self.resolution)
+        if 'Drums' in part:
+            return self.compiled_rules['drums']
+        return self.compiled_rules['single']
+
+    def pick_on_beat(self, rules, beat_number, notes):
+        if rules.bass is None:
+            return notes[:rules.on_beat_notes]
+        if rules.bass == 'first_beat':
+            # Bass only alone, on the first beat
+            if beat_number == 0:
+                for note in notes:
+                    if note.color == 0:
+                        return [note]
+            return notes[:rules.on_beat_notes]
+        # Bass and a note
         ret = []
-        beat_number = self.get_beat(ms)
-
-        on_beat = int(beat_number) == beat_number and beat_number % 2 == 0
-        off_beat = int(beat_number) == beat_number and beat_number % 2 == 1
-        if diff == 'easy':
-            if ms_delta_around > self.resolution * 3:
-                if not off_beat:
-                    on_beat = True
-
-            # 7 -> 0
-            # 4 -> 0
-            # 3 -> 1
-            # No chords
-            if not on_beat:
-                return ret
-            for note in notes[:1]:
-                _, color, length = note.split(' ')
-                if color == '4':
-                    color = '0'
-                elif color == '3':
-                    color = '1'
-                elif color == '7':
-                    color = '0'
-                ret.append('N {} {}'.format(color, length))
-            return ret
-
-        if diff == 'medium':
-            if ms_delta_around > self.resolution * 2:
-                if not off_beat:
-                    on_beat = True
-
-            # 7 -> 0
-            # 4 -> 1
-            # Max 2 lenngth chords
-            if not on_beat and not off_beat:
-                return ret
-            for note in notes[:2]:
-                _, color, length = note.split(' ')
-                if color == '4':
-                    color = '0'
-                elif color == '7':
-                    color = '0'
-                ret.append('N {} {}'.format(color, length))
-            return ret
-
-        if diff == 'hard':
-            if ms_delta_around >= self.resolution:
-                if not off_beat:
-                    on_beat = True
-
-            if int(beat_number * 2) == beat_number * 2:
-                on_beat = True
-
-            # 7 -> 0
-            if not on_beat and not off_beat:
-                return ret
-            return notes
+        for note in notes:
+            if note.color == 0:
+                ret.append(note)
+                break
+        return ret + [note for note in notes if note.color != 0][:rules.on_beat_notes]
+
+    def pick_off_beat(self, rules, notes):
+        ret = notes[:rules.off_beat_notes]
+        if rules.off_beat_bass == 'never' or (rules.off_beat_bass == 'small_chords' and len(notes) > 2):
+            ret = [note for note in ret if note.color != 0]
+        return ret
 
-    def notes_to_diff_drums(self, diff, ms, notes, ms_delta_around=0):
-        ret = []
+    def classify_tick(self, ms, lines, modifiers=False):
+        # Everything about a tick that doesn't depend on the difficulty,
+        # computed once and shared by all of them
         beat_number = self.get_beat(ms)
-        on_beat = int(beat_number) == beat_number and beat_number % 2 == 0
-        off_beat = int(beat_number) == beat_number and beat_number % 2 == 1
+        whole_beat = int(beat_number) == beat_number
+        notes = []
+        others = []
+        for line in lines:
+            if isinstance(line, Note):
+                notes.append(line)
+            else:
+                others.append(line)
 
         ghost_note = False
+        cymbal_notes = ()
+        accent_notes = ()
+        if modifiers:
+            cymbal_notes = set()
+            accent_notes = set()
+            for note in notes:
+                color = note.color
+                if color in (66, 67, 68):
+                    # 66 -> 2
+                    # 67 -> 3
+                    # 68 -> 4
+                    cymbal_notes.add(color - 64)
+                if color in (34, 35, 36):
+                    accent_notes.add(color - 33)
+                if color == 40:
+                    ghost_note = True
+
+            # Remove the cymbal and accent notes from the notes list
+            notes = [
+                note for note in notes
+                if note.color not in DRUM_MODIFIERS
+            ]
+
+        return Tick(
+            ms=ms,
+            beat_number=beat_number,
+            on_beat=whole_beat and beat_number % 2 == 0,
+            off_beat=whole_beat and beat_number % 2 == 1,
+            half_beat=int(beat_number * 2) == beat_number * 2,
+            notes=notes,
+            others=others,
+            ghost_note=ghost_note,
+            cymbal_notes=cymbal_notes,
+            accent_notes=accent_notes,
+        )
+
+    def tick_to_diff(self, rules, tick, ms_delta_around=0):
+        on_beat = tick.on_beat
+        off_beat = tick.off_beat
+        if rules.half_beats and tick.half_beat:
+            on_beat = True
+        if ms_delta_around > rules.gap or (rules.gap_inclusive and ms_delta_around == rules.gap):
+            if not off_beat:
+                on_beat = True
 
-        # Detect cymbal notes (66, 67, 68)
-        cymbal_notes = set()
-        # Detect accent notes (34, 35, 36)
-        accent_notes = set()
-        for note in notes:
-            _, color, length = note.split(' ')
-            if color in ['66', '67', '68']:
-                # 66 -> 2
-                # 67 -> 3
-                # 68 -> 4
-                cymbal_notes.add(str(int(color) - 64))
-
-            if color in ['34', '35', '36']:
-                accent_notes.add(str(int(color) - 33))
-            
-            if color == '40':
-                ghost_note = True
-
-        # Remove the cymbal and accent notes from the notes list
-        notes = [
-            note for note in notes
-            if note.split(' ')[1] not in ['66', '67', '68', '34', '35', '36', '40']
-        ]
+        if on_beat:
+            picked = self.pick_on_beat(rules, tick.beat_number, tick.notes)
+        elif off_beat:
+            picked = self.pick_off_beat(rules, tick.notes)
+        elif not rules.ghost_off_grid:
+            return []
+        else:
+            picked = []
 
+        ms = tick.ms
+        cymbal_notes = tick.cymbal_notes
+        accent_notes = tick.accent_notes
+        ret = []
         # Force add the ghost note
-        if ghost_note:
-            ret.append('N 40 0')
-
-        if diff == 'easy':
-            # if on_beat:
-            #     ret.append('N {} {}'.format('0', '0'))
-            # elif off_beat:
-            #     ret.append('N {} {}'.format('1', '0'))
-            # return ret
-            if ms_delta_around > self.resolution * 3:
-                if not off_beat:
-                    on_beat = True
-
-            # if self.get_effective_bpm(ms) > 150:
-            #     # Skip on beats
-            #     if on_beat and beat_number != 0:
-            #         return ret
-
-            if on_beat:
-                # Allow bass or a single note
-                for note in notes:
-                    _, color, length = note.split(' ')
-                    if color == '0' and beat_number == 0:  # easy bass only on first beat
-                        ret.append('N {} {}'.format(color, length))
-                        break
-                else:
-                    # No bass, allow single note
-                    for note in notes:
-                        _, color, length = note.split(' ')
-                        _cymbal = color in cymbal_notes
-                        _accent = color in accent_notes
-                        if color in ['3', '4']:
-                            color = '2'
-                        ret.append('N {} {}'.format(color, length))
-                        if _cymbal:
-                            ret.append('N {} {}'.format(str(int(color) + 64), length))
-                        if _accent:
-                            ret.append('N {} {}'.format(str(int(color) + 33), length))
-                        break
-
-            return ret
-
-        if diff == 'medium':
-            if ms_delta_around > self.resolution * 2:
-                if not off_beat:
-                    on_beat = True
-            if not on_beat and not off_beat:
-                return []
-
-            # if self.get_effective_bpm(ms) > 150:
-            #     # Skip on beats
-            #     if on_beat and beat_number != 0:
-            #         return ret
-
-            # 2 max chords
-            # 0 only alone
-
-            if on_beat:
-                # Allow bass or a single note
-                for note in notes:
-                    _, color, length = note.split(' ')
-                    if color == '0' and beat_number == 0:  # easy bass only on first beat:
-                        ret.append('N {} {}'.format(color, length))
-                        break
-                else:
-                    # No bass, allow single note
-                    for note in notes:
-                        _, color, length = note.split(' ')
-                        _cymbal = color in cymbal_notes
-                        _accent = color in accent_notes
-                        if color in ['4']:
-                            color = '3'
-
-                        ret.append('N {} {}'.format(color, length))
-                        if _cymbal:
-                            ret.append('N {} {}'.format(str(int(color) + 64), length))
-                        if _accent:
-                            ret.append('N {} {}'.format(str(int(color) + 33), length))
-                        break
-            elif off_beat:
-                # Allow 1-2 notes (no bass)
-                _found_notes = 0
-                for note in notes[:2]:
-                    _, color, length = note.split(' ')
-                    if color != '0':
-                        _cymbal = color in cymbal_notes
-                        _accent = color in accent_notes
-                        if color in ['4']:
-                            color = '3'
-                        ret.append('N {} {}'.format(color, length))
-                        if _cymbal:
-                            ret.append('N {} {}'.format(str(int(color) + 64), length))
-                        if _accent:
-                            ret.append('N {} {}'.format(str(int(color) + 33), length))
-                        _found_notes += 1
-
-            return ret
-
-        if diff == 'hard':
-            # 2 max chords
-            # 0 with one note
-            if ms_delta_around > self.resolution:
-                if not off_beat:
-                    on_beat = True
-
-            if on_beat:
-                # Allow bass and a single note
-                for note in notes:
-                    _, color, length = note.split(' ')
-                    if color == '0':
-                        ret.append('N {} {}'.format(color, length))
-                        break
-
-                # No bass, allow single note
-                for note in notes:
-                    _, color, length = note.split(' ')
-                    if color == '0':
-                        continue
-                    ret.append('N {} {}'.format(color, length))
-                    _cymbal = color in cymbal_notes
-                    _accent = color in accent_notes
-                    if _cymbal:
-                        ret.append('N {} {}'.format(str(int(color) + 64), length))
-                    if _accent:
-                        ret.append('N {} {}'.format(str(int(color) + 33), length))
-                    break
-
-            elif off_beat:
-                for note in notes[:2]:
-                    _, color, length = note.split(' ')
-                    if len(notes) > 2 and color == '0':
-                        continue
-                    ret.append('N {} {}'.format(color, length))
-                    _cymbal = color in cymbal_notes
-                    _accent = color in accent_notes
-                    if _cymbal:
-                        ret.append('N {} {}'.format(str(int(color) + 64), length))
-                    if _accent:
-                        ret.append('N {} {}'.format(str(int(color) + 33), length))
-            return ret
-
+        if tick.ghost_note:
+            ret.append(Note(ms, 40, 0))
+        for note in picked:
+            color = rules.map_color(note.color)
+            ret.append(note if color == note.color else Note(ms, color, note.length))
+            if note.color in cymbal_notes:
+                ret.append(Note(ms, color + 64, note.length))
+            if note.color in accent_notes:
+                ret.append(Note(ms, color + 33, note.length))
         return ret
 
-    def parse_expert_part(self, part, part_lines):
-        og_part_modified = False
-        logger.debug("parsing expert track %s", part)
-        difficulty_lines = defaultdict(list)
+    def convert_double_kicks(self, events, notes_by_ms, event_index_by_note):
+        # Rewrite kicks in place in a single pass, both in events and
+        # notes_by_ms, so the part doesn't need to be parsed again.
+        # Returns the number of rewritten kicks.
+        rewritten = 0
+        prev_kick = -1000
+        for ms, lines in notes_by_ms.items():
+            for position, note in enumerate(lines):
+                if not isinstance(note, Note):
+                    continue
+                if self.doublekick > 0 and note.color == 0:
+                    # This is a kick
+                    millis_since_last_kick = self.ms_to_real_time_diff(ms, prev_kick)
+                    prev_kick = ms
+                    if millis_since_last_kick >= self.doublekick:
+                        continue
+                    logger.debug("%s: %s, Converting to 2x kick", ms, millis_since_last_kick)
+                    note = note._replace(color=32)
+                elif self.doublekick < 0 and note.color == 32:
+                    logger.debug("%s, Converting 2x kick to normal", ms)
+                    note = note._replace(color=0)
+                else:
+                    continue
+                rewritten += 1
+                lines[position] = note
+                events[event_index_by_note[ms, position]] = (ms, note)
+        return rewritten
+
+    def notes_by_tick(self, events, index_events=False):
+        # Returns (notes_by_ms, event_index_by_note, note count) of a part.
+        # event_index_by_note is only built with index_events, for
+        # convert_double_kicks, and is None otherwise.
         notes_by_ms = defaultdict(list)
-        for line in part_lines:
-            if '=' not in line:
+        # (ms, position in notes_by_ms[ms]) -> index in events
+        event_index_by_note = {} if index_events else None
+        note_count = 0
+        for event_index, (ms, value) in enumerate(events):
+            if ms is None:
                 continue
             try:
-                ms, value = [_line__part.strip() for _line__part in line.split('=')]
+                ms = int(ms)
             except ValueError:
-                logger.error("Error parsing line %s", line)
-            ms = int(ms)
-            notes_by_ms[ms].append(value)
-        
-        prev_ms_by_diff = {}
-        if 'Drums' in part:
-            prev_kick = -1000
-            for ms, lines in notes_by_ms.items():
-                notes = [_line for _line in lines if _line.startswith('N ')]
-                for note in notes:
-                    _, color, length = note.split(' ')
-                    if self.doublekick > 0 and color == '0':
-                        # This is a kick
-                        millis_since_last_kick = self.ms_to_real_time_diff(ms, prev_kick)
-                        prev_kick = ms
-                        if millis_since_last_kick < self.doublekick:
-                            logger.info("%s: %s, Converting to 2x kick", ms, millis_since_last_kick)
-                            old_note = f"{ms} = N 0 {length}"
-                            new_note = f"{ms} = N 32 {length}"
-                            for index, line in enumerate(part_lines):
-                                if line.strip() == old_note:
-                                    part_lines[index] = new_note
-                                    og_part_modified = True
-                                    break
-                        else:
-                            prev_kick = ms
-                    elif self.doublekick < 0 and color == '32':
-                        logger.info("%s, Converting 2x kick to normal", ms)
-                        old_note = f"{ms} = N 32 {length}"
-                        new_note = f"{ms} = N 0 {length}"
-                        for index, line in enumerate(part_lines):
-                            if line.strip() == old_note:
-                                part_lines[index] = new_note
-                                og_part_modified = True
-                                break
-
-            if og_part_modified:
-                notes_by_ms = defaultdict(list)
-                for line in part_lines:
-                    if '=' not in line:
-                        continue
-                    ms, value = [_line__part.strip() for _line__part in line.split('=')]
-                    ms = int(ms)
-                    notes_by_ms[ms].append(value)
-        
-
-        index = 0
-        for ms, lines in notes_by_ms.items():
-            notes = [_line for _line in lines if _line.startswith('N ')]
+                logger.error("Error parsing line %s = %s", ms, value)
+                continue
+            if value.startswith('N '):
+                try:
+                    _, color, length = value.split(' ')
+                    value = Note(ms, int(color), int(length))
+                    note_count += 1
+                except ValueError:
+                    logger.error("Error parsing line %s = %s", ms, value)
+                    continue
+            lines = notes_by_ms[ms]
+            if index_events:
+                event_index_by_note[ms, len(lines)] = event_index
+            lines.append(value)
+        return notes_by_ms, event_index_by_note, note_count
+
+    def parse_expert_part(self, part, events):
+        rewritten_kicks = 0
+        logger.debug("parsing expert track %s", part)
+        doublekick = 'Drums' in part and self.doublekick != 0
+        notes_by_ms, event_index_by_note, note_count = self.notes_by_tick(events, index_events=doublekick)
+        self.profile.count('ticks', len(notes_by_ms))
+        self.profile.count('notes_in', note_count)
+
+        if doublekick:
+            # Rewrite a copy, the chart itself is left untouched
+            events = list(events)
+            with self.profile.phase('doublekick'):
+                rewritten_kicks = self.convert_double_kicks(events, notes_by_ms, event_index_by_note)
+            if rewritten_kicks:
+                self.profile.count('kicks_rewritten', rewritten_kicks)
+                if self.doublekick > 0:
+                    logger.info("Converted %s kicks to 2x kicks", rewritten_kicks)
+                else:
+                    logger.info("Converted %s 2x kicks to normal kicks", rewritten_kicks)
 
+        with self.profile.phase('reduce'):
+            difficulty_lines, priorities = self.reduce_part(part, notes_by_ms)
+            rules = self.get_rules(part)
             for diff in self.parts_to_generate:
-                prev_ms_by_diff[diff] = prev_ms_by_diff.get(diff) or 0
-                for non_note_line in lines:
-                    if non_note_line in notes:
-                        continue
-                    difficulty_lines[diff].append('{} = {}'.format(ms, non_note_line))
-                if 'Drums' not in part:
-                    for easy_note in self.notes_to_diff_single(diff, ms, notes, ms_delta_around=(ms - prev_ms_by_diff[diff])):
-                        prev_ms_by_diff[diff] = ms
-                        difficulty_lines[diff].append('{} = {}'.format(ms, easy_note))
-                else:
-                    for easy_note in self.notes_to_diff_drums(diff, ms, notes, ms_delta_around=(ms - prev_ms_by_diff[diff])):
-                        prev_ms_by_diff[diff] = ms
-                        difficulty_lines[diff].append('{} = {}'.format(ms, easy_note))
-            index += 1
-        
+                difficulty_lines[diff] = self.cap_nps(rules[diff], difficulty_lines[diff], priorities)
+
         for diff in self.parts_to_generate:
             easy_part = part.replace('Expert', diff.capitalize())
             logger.debug("Got new part %s (lines: %s)", easy_part, len(difficulty_lines[diff]))
-            self.new_parts[easy_part] = ['{'] + difficulty_lines[diff] + ['}']
+            self.new_parts[easy_part] = difficulty_lines[diff]
+            self.profile.count('notes_out.' + easy_part, sum(
+                1 for _, value in difficulty_lines[diff] if isinstance(value, Note)
+            ))
 
-        if og_part_modified:
+        if rewritten_kicks:
             # possibly modified original part
-            self.new_parts[part] = part_lines + ['}']
+            self.new_parts[part] = events
+
+    def cap_nps(self, rules, lines, priorities):
+        # Drop chords until no second of the part has more than
+        # rules.max_nps of them. A single pass over the chords: the kept
+        # chords of the last second are in a deque per beat priority
+        # (priorities from reduce_part), and when a second is full the
+        # latest chord of the lowest priority, or the new chord itself, is
+        # dropped.
+        if not rules.max_nps or not self.tempo_map.bpm_ticks:
+            return lines
+        # The notes of a tick are next to each other, and the ticks are in
+        # order unless they weren't in the chart
+        chord_ticks = []
+        in_order = True
+        for ms, value in lines:
+            if isinstance(value, Note) and (not chord_ticks or chord_ticks[-1] != ms):
+                if chord_ticks and ms < chord_ticks[-1]:
+                    in_order = False
+                chord_ticks.append(ms)
+        if not in_order:
+            chord_ticks = sorted(set(chord_ticks))
+        windows = (deque(), deque(), deque())
+        kept = 0
+        dropped = set()
+        for ms, seconds in zip(chord_ticks, self.tempo_map.iter_seconds(chord_ticks)):
+            for window in windows:
+                while window and seconds - window[0][0] >= 1.0:
+                    window.popleft()
+                    kept -= 1
+            priority = priorities[ms]
+            if kept < rules.max_nps:
+                windows[priority].append((seconds, ms))
+                kept += 1
+                continue
+            lowest = next(index for index, window in enumerate(windows) if window)
+            if priority <= lowest:
+                dropped.add(ms)
+                continue
+            dropped.add(windows[lowest].pop()[1])
+            windows[priority].append((seconds, ms))
+        if not dropped:
+            return lines
+        self.profile.count('chords_capped', len(dropped))
+        logger.debug("Dropped %s chords over %s notes per second", len(dropped), rules.max_nps)
+        return [
+            (ms, value) for ms, value in lines
+            if not (ms in dropped and isinstance(value, Note))
+        ]
+
+    def analyze_part(self, part, events):
+        # Statistics of an Expert part for --analyze, nothing is reduced
+        notes_by_ms, event_index_by_note, note_count = self.notes_by_tick(events)
+        flags = DRUM_MODIFIERS if 'Drums' in part else SINGLE_MODIFIERS
+        # Seconds of every playable note, in tick order
+        note_seconds = []
+        chords = 0
+        for ms in sorted(notes_by_ms):
+            count = sum(
+                1 for note in notes_by_ms[ms] if isinstance(note, Note) and note.color not in flags
+            )
+            if count:
+                chords += 1
+                note_seconds.extend([self.tempo_map.seconds_at(ms) or 0.0] * count)
+
+        # Most notes in any one second, with a sliding window
+        peak_nps = 0
+        window = deque()
+        for seconds in note_seconds:
+            window.append(seconds)
+            while seconds - window[0] >= 1.0:
+                window.popleft()
+            peak_nps = max(peak_nps, len(window))
+
+        length = note_seconds[-1] - note_seconds[0] if note_seconds else 0.0
+        kicks = 0
+        if 'Drums' in part and self.doublekick != 0:
+            kicks = self.convert_double_kicks(list(events), notes_by_ms, event_index_by_note)
+        return {
+            'notes': len(note_seconds),
+            'chords': chords,
+            'seconds': round(length, 3),
+            'nps': round(len(note_seconds) / length, 2) if length > 0 else 0.0,
+            'peak_nps': peak_nps,
+            'doublekick_rewrites': kicks,
+        }
 
-    def parse_sync_track_part(self, part_lines):
+    def reduce_part(self, part, notes_by_ms):
+        # Returns (lines per difficulty, priority per tick). The priority is
+        # 2 for on beats, 1 for off beats and 0 for ticks off the grid, for
+        # cap_nps.
+        difficulty_lines = defaultdict(list)
+        priorities = {}
+        rules = self.get_rules(part)
+        if self.numpy_engine:
+            reducer = ColumnarReducer(self)
+            difficulty_lines = reducer.reduce(rules, notes_by_ms, self.parts_to_generate)
+            return difficulty_lines, reducer.priorities()
+
+        # Each tick is classified once, then reduced for every difficulty
+        diffs = [
+            (diff, rules[diff], difficulty_lines[diff]) for diff in self.parts_to_generate
+        ]
+        modifiers = diffs[0][1].modifiers
+        prev_ms_by_diff = dict.fromkeys(self.parts_to_generate, 0)
+        for ms, lines in notes_by_ms.items():
+            tick = self.classify_tick(ms, lines, modifiers)
+            priorities[ms] = 2 if tick.on_beat else 1 if tick.off_beat else 0
+            others = [(ms, line) for line in tick.others]
+            for diff, diff_rules, diff_lines in diffs:
+                if others:
+                    diff_lines.extend(others)
+                for easy_note in self.tick_to_diff(diff_rules, tick, ms_delta_around=(ms - prev_ms_by_diff[diff])):
+                    prev_ms_by_diff[diff] = ms
+                    diff_lines.append((ms, easy_note))
+        return difficulty_lines, priorities
+
+    def parse_sync_track_part(self, events):
         sync_track = []
-        for line in part_lines:
-            if '=' not in line:
+        for key, value in events:
+            if key is None:
                 continue
-            key, value = [_line__part.strip() for _line__part in line.split('=')]
-            key = key.strip()
             sync_track.append((key, value))
         self.sync_track = sync_track
         self.handle_sync_track()
 
-    def parse_song_part(self, part_lines):
+    def parse_song_part(self, events):
         logger.debug("parsing song part")
-        for line in part_lines:
-            if '=' not in line:
-                continue
-            try:
-                key, value = [_line__part.strip() for _line__part in line.split('=')]
-            except ValueError:
-                logger.error("Error parsing line %s", line)
+        for key, value in events:
             if key == 'Resolution':
                 self.resolution = int(value)
 
-    def parse_file(self, lines):
-        part = None
-        part_lines = []
-        for line in lines:
-            line = line.strip()
-            self.lines.append(line)
-            if '[Song]' in line:
-                part = '[Song]'
-                continue
-            if '[SyncTrack]' in line:
-                part = '[SyncTrack]'
-                continue
-            if line == '}':
-                if part:
-                    if part == '[Song]':
-                        self.parse_song_part(part_lines)
-                    if part == '[SyncTrack]':
-                        self.parse_sync_track_part(part_lines)
-                    part = None
-                    part_lines = []
-
-            if part:
-                part_lines.append(line)
+    def section_events(self, section):
+        # Sections are decoded and tokenized on first use, which is
+        # counted as reading the chart
+        with self.profile.phase('read'):
+            return section.events
+
+    def parse_header(self, chart):
+        # Resolution and tempo map, needed before any part
+        self.chart = chart
+        for section in self.chart.sections:
+            if section.name == '[Song]':
+                self.parse_song_part(self.section_events(section))
+            if section.name == '[SyncTrack]':
+                events = self.section_events(section)
+                with self.profile.phase('sync_track'):
+                    self.parse_sync_track_part(events)
 
-        for line in lines:
-            line = line.strip()
-            if re.match(r'^\[\w*\]$', line):
-                part = line
-                continue
-            if line == '}':
-                if part:
-                    if '[Expert' in part:
-                        self.parse_expert_part(part, part_lines)
-                    part = None
-                    part_lines = []
-
-            if part:
-                part_lines.append(line)
-
-    def write_file(self, new_filename):
-        new_lines = []
-
-        replace = False
-
-        parts = defaultdict(list)
-        part = None
-        for line in self.lines:
-            line = line.strip()
-            if '=' not in line and re.match(r'^.*\[.*\].*$', line):
-                part = line.strip()
-                parts[part].append(line)
-                continue
-            elif not part:
-                logger.debug("Skipping pre part line %s", line)
-                continue
+    def parse_file(self, lines):
+        if isinstance(lines, Chart):
+            self.parse_header(lines)
+        else:
+            self.parse_header(tokenize_chart(lines))
 
-            if line == '}':
-                if part:
-                    parts[part].append(line)
-                    part = None
+        expert_sections = [
+            section for section in self.chart.sections if section.name.startswith('[Expert')
+        ]
+        if self.low_memory:
+            # Only one Expert part and what's generated from it is in
+            # memory at a time
+            section_jobs = getattr(self.options, 'section_jobs', 1)
+            if section_jobs != 1 and len(expert_sections) > 1:
+                logger.warning("--section_jobs is ignored with --low_memory")
+            for section in expert_sections:
+                self.parse_expert_part(section.name, self.section_events(section))
+                self.spill_new_parts()
+                if section.buffer is not None:
+                    # Tokenized again if it's needed
+                    section.events = None
+            return
+        section_jobs = getattr(self.options, 'section_jobs', 1)
+        if section_jobs is None or section_jobs <= 0:
+            section_jobs = os.cpu_count() or 1
+        if section_jobs > 1 and len(expert_sections) > 1:
+            self.parse_expert_parts_in_parallel(expert_sections, section_jobs)
+            return
+        for section in expert_sections:
+            self.parse_expert_part(section.name, self.section_events(section))
+
+    def parse_expert_parts_in_parallel(self, sections, jobs):
+        # Each worker builds the tempo map once and reduces whole parts.
+        # Results are merged in chart order, so new_parts is the same as
+        # when parsing one part at a time.
+        worker_options = copy.copy(self.options)
+        worker_options.numpy = self.numpy_engine
+        worker_options.section_jobs = 1
+        jobs = min(jobs, len(sections))
+        logger.debug("Reducing %s parts using %s processes", len(sections), jobs)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_section_worker,
+            initargs=(worker_options, self.resolution, self.sync_track, logger.level),
+        ) as executor:
+            results = executor.map(reduce_section_worker, [section.detach() for section in sections])
+            for new_parts, profile, records in results:
+                for record in records:
+                    logger.handle(record)
+                self.new_parts.update(new_parts)
+                self.profile.merge(profile)
+
+    def spill_new_parts(self):
+        # Write the new parts that are still in memory to the spill file,
+        # formatted as they are in the output. Their events in new_parts
+        # are replaced with None.
+        started = time.perf_counter()
+        sort_seconds = self.profile.timings['sort']
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        header_size = len(self.chart.newline.encode()) * 2 + 1
+        try:
+            for partname, events in self.new_parts.items():
+                if events is None:
                     continue
-
-            if part:
-                parts[part].append(line)
+                raw_start = self.spill.tell()
+                self.write_section(self.spill, partname, events)
+                raw_end = self.spill.tell()
+                # The same ranges as index_chart would find
+                start = raw_start + len(partname.encode(CHART_ENCODING, CHART_ENCODING_ERRORS)) + header_size
+                self.spilled_parts[partname] = (start, raw_end - 1, raw_start, raw_end)
+                self.new_parts[partname] = None
+        finally:
+            sort_seconds = self.profile.timings['sort'] - sort_seconds
+            self.profile.timings['write'] += time.perf_counter() - started - sort_seconds
+
+    def map_spill(self):
+        if self.spilled_parts and self.spill_buffer is None:
+            self.spill.flush()
+            self.spill_buffer = mmap.mmap(self.spill.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        # Remove the spill file of --low_memory
+        if self.spill_buffer is not None:
+            self.spill_buffer.close()
+            self.spill_buffer = None
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+    def iter_output_sections(self):
+        # Yields (partname, section) in output order. Existing sections
+        # come from the chart as they are, new parts are wrapped in a
+        # ChartSection.
+        # Every section is kept, a chart may have a name more than once
+        # (e.g. two [Events])
+        parts = {section.name for section in self.chart.sections}
 
         added_parts = []
-        for partname, lines in parts.items():
+        for section in self.chart.sections:
+            partname = section.name
             if partname in self.new_parts.keys():
                 if self.force_replace_parts:
                     logger.info("Replacing existing part %s", partname)
+                    self.replaced_parts.append(partname)
                     continue
                 else:
                     logger.info("Part %s already exists, skipping", partname)
+                    self.skipped_parts.append(partname)
             added_parts.append(partname)
-            new_lines.extend(lines)
+            yield partname, section
 
-        for partname, lines in self.new_parts.items():
+        for partname, events in self.new_parts.items():
             if not self.force_replace_parts:
-                if partname in parts.keys():
+                if partname in parts:
                     continue
             if partname in added_parts:
                 continue
             added_parts.append(partname)
-            new_lines.append(partname)
-            new_lines.extend(lines)
-
-        # Sort newlines, so that lines that start with a number are sorted by number
-        lines_by_mode = {
-            'start': [],
-            'middle': [],
-            'end': [],
-        }
-        mode = "start"
-        for line in new_lines:
-            starts_with_number = re.match(r'^\d+', line.strip())
-            if starts_with_number:
-                if mode == "start":
-                    mode = "middle"
+            if partname in self.spilled_parts:
+                section = ChartSection(partname, self.spill_buffer, *self.spilled_parts[partname])
             else:
-                if mode == "middle":
-                    mode = "end"
-            lines_by_mode[mode].append(line)
+                section = ChartSection(partname)
+                section.events = events
+            yield partname, section
+
+    def write_section(self, f, partname, events):
+        with self.profile.phase('sort'):
+            events = ordered_events(events)
+        f.write(self.chart.newline.join(itertools.chain(
+            (partname,), format_section(events)
+        )).encode(CHART_ENCODING, CHART_ENCODING_ERRORS))
+
+    def write(self, f):
+        # Write the chart to the binary file object f. Sections that
+        # weren't changed are copied from the source buffer byte for byte,
+        # only new parts are formatted, with the line endings of the source.
+        started = time.perf_counter()
+        sort_seconds = self.profile.timings['sort']
+        encoded_newline = self.chart.newline.encode()
+        self.map_spill()
+        try:
+            with memoryview(self.chart.buffer or b'') as source, memoryview(self.spill_buffer or b'') as spilled:
+                separator = b''
+                for partname, section in self.iter_output_sections():
+                    f.write(separator)
+                    separator = encoded_newline
+                    if section.raw_end is not None and section.buffer is self.chart.buffer:
+                        f.write(source[section.raw_start:section.raw_end])
+                        continue
+                    if section.raw_end is not None and section.buffer is self.spill_buffer:
+                        f.write(spilled[section.raw_start:section.raw_end])
+                        continue
+                    self.write_section(f, partname, section.events)
+                if self.chart.final_newline:
+                    f.write(encoded_newline)
+        finally:
+            # Sorting is reported on its own
+            sort_seconds = self.profile.timings['sort'] - sort_seconds
+            self.profile.timings['write'] += time.perf_counter() - started - sort_seconds
+
+    def write_file(self, new_filename):
+        # Stream the output to a temporary file next to the target and
+        # rename it into place, so an interrupted run never leaves a
+        # truncated chart behind.
+        tmp_filename = '{}.{}.tmp'.format(new_filename, uuid.uuid4().hex[:8])
+        try:
+            with open(tmp_filename, 'xb', buffering=WRITE_BUFFER_SIZE) as f:
+                self.write(f)
+                # On disk before the rename, or a power loss could leave
+                # an empty chart in place of the original
+                f.flush()
+                os.fsync(f.fileno())
+            # The chart may be mapped from the file being replaced, which
+            # Windows doesn't allow
+            self.chart.close()
+            if os.path.exists(new_filename):
+                shutil.copymode(new_filename, tmp_filename)
+            os.replace(tmp_filename, new_filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+
+class ColumnarReducer():
+    # Vectorized version of Parser.tick_to_diff. A part is loaded into
+    # columnar arrays and all difficulties are reduced from them at once.
+    # The output is identical to the per tick reducer.
+
+    # Output slots of a tick, in the order the per tick reducers emit them
+    SLOT_GHOST = 0
+    SLOT_FIRST = 1
+    SLOT_CYMBAL = 1
+    SLOT_ACCENT = 2
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def load(self, notes_by_ms):
+        ticks = []
+        event_group = []
+        event_color = []
+        event_length = []
+        self.values = []
+        for group, (ms, lines) in enumerate(notes_by_ms.items()):
+            ticks.append(ms)
+            for value in lines:
+                event_group.append(group)
+                self.values.append(value)
+                if isinstance(value, Note):
+                    event_color.append(value.color)
+                    event_length.append(value.length)
+                else:
+                    event_color.append(-1)
+                    event_length.append(0)
+
+        self.ticks = numpy.array(ticks, dtype=numpy.int64)
+        self.event_group = numpy.array(event_group, dtype=numpy.int64)
+        self.event_color = numpy.array(event_color, dtype=numpy.int64)
+        self.event_length = numpy.array(event_length, dtype=numpy.int64)
+        self.event_is_note = self.event_color >= 0
+        self.group_count = len(ticks)
+
+        self.beat = self.get_beats(self.ticks)
+        whole_beat = numpy.trunc(self.beat) == self.beat
+        self.on_beat = whole_beat & (numpy.mod(self.beat, 2) == 0)
+        self.off_beat = whole_beat & (numpy.mod(self.beat, 2) == 1)
+        self.half_beat = numpy.trunc(self.beat * 2) == self.beat * 2
+
+    def get_beats(self, ticks):
+        # Parser.get_beat for all ticks
+        parser = self.parser
+        tempo_map = parser.tempo_map
+        ts_ticks = numpy.array(tempo_map.ts_ticks, dtype=numpy.int64)
+        index = numpy.maximum(numpy.searchsorted(ts_ticks, ticks, side='right') - 1, 0)
+        ts = numpy.array(tempo_map.ts_values, dtype=numpy.int64)[index]
+        resolution = parser.resolution
+        if parser.bpm_multiplier != 1:
+            ts = (ts * parser.bpm_multiplier).astype(numpy.int64)
+            resolution = int(resolution / parser.bpm_multiplier)
+        return numpy.mod((ticks - ts_ticks[index]) / resolution, ts)
+
+    def ranks(self, mask):
+        # Event indexes for mask and their position inside their tick
+        events = numpy.flatnonzero(mask)
+        groups = self.event_group[events]
+        return events, groups, numpy.arange(len(events)) - numpy.searchsorted(groups, groups, side='left')
+
+    def nth(self, mask, n):
+        # Per tick: index of the nth event matching mask, or -1
+        events, groups, ranks = self.ranks(mask)
+        ret = numpy.full(self.group_count, -1, dtype=numpy.int64)
+        selected = ranks == n
+        ret[groups[selected]] = events[selected]
+        return ret
+
+    def resolve_on_beat(self, forced_on, keep_if_on, keep_if_not_on, threshold, inclusive=False):
+        # The per tick reducer treats a tick as on beat if it's far enough
+        # from the previous tick that produced notes. That only depends on
+        # earlier decisions for ticks that are neither on nor off beat, so
+        # only those are resolved one by one.
+        on = forced_on.copy()
+        kept = numpy.where(forced_on, keep_if_on, keep_if_not_on)
+        undecided = ~forced_on & ~self.off_beat
+        if not undecided.any():
+            return on
+
+        # Last decided kept tick before each tick
+        decided_kept = numpy.where(kept & ~undecided, numpy.arange(self.group_count), -1)
+        prev_decided = numpy.concatenate(([-1], numpy.maximum.accumulate(decided_kept)[:-1]))
+
+        ticks = self.ticks.tolist()
+        keep_if_on = keep_if_on.tolist()
+        keep_if_not_on = keep_if_not_on.tolist()
+        prev_decided = prev_decided.tolist()
+        last_kept = -1
+        for group in numpy.flatnonzero(undecided).tolist():
+            prev = max(prev_decided[group], last_kept)
+            gap = ticks[group] - (ticks[prev] if prev >= 0 else 0)
+            if gap > threshold or (inclusive and gap == threshold):
+                on[group] = True
+                if keep_if_on[group]:
+                    last_kept = group
+            elif keep_if_not_on[group]:
+                last_kept = group
+        return on
+
+    def remap(self, colors, rules):
+        table = numpy.array(rules.color_table, dtype=numpy.int64)
+        if not len(table):
+            return colors
+        mapped = table[numpy.minimum(colors, len(table) - 1)]
+        return numpy.where(colors < len(table), mapped, colors)
+
+    def pick(self, mask, limit, offset=0):
+        # (events, ticks, pick index) of the first `limit` events matching
+        # mask in each tick
+        events, groups, ranks = self.ranks(mask)
+        if limit is not None:
+            selected = ranks < limit
+            events, groups, ranks = events[selected], groups[selected], ranks[selected]
+        return events, groups, ranks + offset
+
+    def pick_per_tick(self, events):
+        # Same as pick, for a per tick array of event indexes (-1 = none)
+        groups = numpy.flatnonzero(events >= 0)
+        return events[groups], groups, numpy.zeros(len(groups), dtype=numpy.int64)
+
+    @staticmethod
+    def join_picks(*picks):
+        return tuple(numpy.concatenate(columns) for columns in zip(*picks))
+
+    @staticmethod
+    def filter_picks(picks, selected):
+        return tuple(column[selected] for column in picks)
+
+    def reduce_with_rules(self, rules):
+        color = self.event_color
+        ghost = numpy.zeros(self.group_count, dtype=bool)
+        cymbals = numpy.zeros(self.group_count, dtype=numpy.int64)
+        accents = numpy.zeros(self.group_count, dtype=numpy.int64)
+        is_note = self.event_is_note
+        if rules.modifiers:
+            is_note = is_note & ~numpy.isin(color, DRUM_MODIFIERS)
+            cymbal_events = numpy.isin(color, (66, 67, 68))
+            numpy.bitwise_or.at(cymbals, self.event_group[cymbal_events], 1 << (color[cymbal_events] - 64))
+            accent_events = numpy.isin(color, (34, 35, 36))
+            numpy.bitwise_or.at(accents, self.event_group[accent_events], 1 << (color[accent_events] - 33))
+            ghost[self.event_group[color == 40]] = True
+        note_count = numpy.bincount(self.event_group[is_note], minlength=self.group_count)
+
+        # Parser.pick_on_beat
+        if rules.bass is None:
+            on_picks = self.pick(is_note, rules.on_beat_notes)
+        elif rules.bass == 'first_beat':
+            bass = self.nth(is_note & (color == 0), 0)
+            bass_on_first_beat = (bass >= 0) & (self.beat == 0)
+            note_picks = self.pick(is_note, rules.on_beat_notes)
+            on_picks = self.join_picks(
+                self.filter_picks(note_picks, ~bass_on_first_beat[note_picks[1]]),
+                self.pick_per_tick(numpy.where(bass_on_first_beat, bass, -1)),
+            )
+        else:
+            on_picks = self.join_picks(
+                self.pick_per_tick(self.nth(is_note & (color == 0), 0)),
+                self.pick(is_note & (color != 0), rules.on_beat_notes, offset=1),
+            )
+
+        # Parser.pick_off_beat
+        off_picks = self.pick(is_note, rules.off_beat_notes)
+        if rules.off_beat_bass == 'never':
+            off_picks = self.filter_picks(off_picks, color[off_picks[0]] != 0)
+        elif rules.off_beat_bass == 'small_chords':
+            off_picks = self.filter_picks(
+                off_picks, ~((note_count[off_picks[1]] > 2) & (color[off_picks[0]] == 0))
+            )
+
+        on_any = numpy.zeros(self.group_count, dtype=bool)
+        on_any[on_picks[1]] = True
+        off_any = numpy.zeros(self.group_count, dtype=bool)
+        off_any[off_picks[1]] = True
+
+        off = self.off_beat
+        forced_on = self.on_beat
+        if rules.half_beats:
+            forced_on = forced_on | self.half_beat
+        on = self.resolve_on_beat(
+            forced_on,
+            ghost | on_any,
+            numpy.where(off, ghost | off_any, ghost & rules.ghost_off_grid),
+            rules.gap,
+            rules.gap_inclusive,
+        )
+        off = off & ~on
+
+        columns = []
+        ghost_groups = numpy.flatnonzero(ghost & (on | off | rules.ghost_off_grid))
+        columns.append((
+            ghost_groups,
+            numpy.full(len(ghost_groups), self.SLOT_GHOST),
+            numpy.full(len(ghost_groups), 40),
+            numpy.zeros(len(ghost_groups), dtype=numpy.int64),
+        ))
+        events, groups, index = self.join_picks(
+            self.filter_picks(on_picks, on[on_picks[1]]),
+            self.filter_picks(off_picks, off[off_picks[1]]),
+        )
+        original_colors = color[events]
+        colors = self.remap(original_colors, rules)
+        lengths = self.event_length[events]
+        slots = self.SLOT_FIRST + index * 3
+        columns.append((groups, slots, colors, lengths))
+        if rules.modifiers:
+            for offset, bits, colors_with_modifier, added in (
+                (self.SLOT_CYMBAL, cymbals, (2, 3, 4), 64),
+                (self.SLOT_ACCENT, accents, (1, 2, 3), 33),
+            ):
+                has_modifier = numpy.isin(original_colors, colors_with_modifier)
+                has_modifier &= ((bits[groups] >> numpy.clip(original_colors, 0, 8)) & 1) == 1
+                columns.append((
+                    groups[has_modifier],
+                    slots[has_modifier] + offset,
+                    colors[has_modifier] + added,
+                    lengths[has_modifier],
+                ))
+        return self.build_output(columns)
+
+    def build_output(self, note_columns):
+        # Non note lines first, then the notes in slot order, per tick
+        non_notes = numpy.flatnonzero(~self.event_is_note)
+        groups = [self.event_group[non_notes]]
+        slots = [numpy.full(len(non_notes), -1)]
+        colors = [numpy.full(len(non_notes), -1)]
+        lengths = [non_notes]
+        for column_groups, column_slots, column_colors, column_lengths in note_columns:
+            groups.append(column_groups)
+            slots.append(column_slots)
+            colors.append(column_colors)
+            lengths.append(column_lengths)
+        groups = numpy.concatenate(groups)
+        slots = numpy.concatenate(slots)
+        colors = numpy.concatenate(colors)
+        lengths = numpy.concatenate(lengths)
+        order = numpy.lexsort((lengths * (slots < 0), slots, groups))
+
+        ticks = self.ticks[groups[order]].tolist()
+        colors = colors[order].tolist()
+        lengths = lengths[order].tolist()
+        values = self.values
+        return [
+            (ms, values[length] if color < 0 else Note(ms, color, length))
+            for ms, color, length in zip(ticks, colors, lengths)
+        ]
 
-        new_lines = lines_by_mode['start'] + sorted(lines_by_mode['middle'], key=lambda l: int(l.split(' ')[0])) + lines_by_mode['end']
+    def priorities(self):
+        # Parser.reduce_part priorities of the loaded ticks
+        priority = self.on_beat * 2 + self.off_beat
+        return dict(zip(self.ticks.tolist(), priority.tolist()))
 
-        with open(new_filename, 'w') as f:
-            f.write('\n'.join(new_lines))
+    def reduce(self, rules, notes_by_ms, diffs):
+        self.load(notes_by_ms)
+        return {diff: self.reduce_with_rules(rules[diff]) for diff in diffs}
 
 
 class FileFinder():
@@ -615,23 +1601,742 @@ class FileFinder():
             self.path = args.directory
 
 
+    def iter_files(self):
+        # Yields files as they are found, so converting can start before
+        # a large library has been walked completely
+        if not self.batch:
+            yield self.path
+            return
+        for entry in self.iter_entries():
+            yield entry.path
+
+    def iter_stats(self):
+        # (filename, (mtime_ns, size)) of each file, for --watch. Files
+        # removed while listing are left out.
+        if not self.batch:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return
+            yield self.path, (stat.st_mtime_ns, stat.st_size)
+            return
+        for entry in self.iter_entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            yield entry.path, (stat.st_mtime_ns, stat.st_size)
+
+    def iter_entries(self):
+        # Find all .chart files in path self.path and subfolders
+        dirs = [self.path]
+        while dirs:
+            try:
+                with os.scandir(dirs.pop()) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError as e:
+                logger.warning("Can't read directory %s: %s", e.filename, e.strerror)
+                continue
+            subdirs = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith('.chart') and not entry.name.endswith('_easy.chart'):
+                    yield entry
+            dirs.extend(reversed(subdirs))
+
+    def count_files(self, log=False):
+        count = 0
+        for filename in self.iter_files():
+            if log:
+                logger.info("{}".format(filename))
+            count += 1
+        return count
+
     def list_files(self):
-        if self.batch:
-            # Find all .chart files in path self.path and subfolders
-            return [os.path.join(dirpath, f)
-                    for dirpath, dirnames, files in os.walk(self.path)
-                    for f in files if f.endswith('.chart') and not f.endswith('_easy.chart')]
+        return list(self.iter_files())
+
+
+READ_AHEAD = 4
+
+
+def read_ahead(filenames, count=READ_AHEAD):
+    # Yields (filename, chart) for filenames, reading and indexing up to
+    # count files ahead in a thread so disk and network reads overlap the
+    # conversion of the current file. chart is None for files that can't
+    # be read, they're read again by the converter, which reports the
+    # error for that file.
+    buffer = queue.Queue(maxsize=count)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for filename in filenames:
+                started = time.perf_counter()
+                try:
+                    chart = read_chart(filename)
+                    chart.read_seconds = time.perf_counter() - started
+                except OSError:
+                    chart = None
+                if not put((filename, chart)):
+                    if chart is not None:
+                        chart.close()
+                    return
+        except Exception as e:
+            put((None, e))
+        put(done)
+
+    thread = threading.Thread(target=reader, name="easygen-read-ahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            filename, chart = item
+            if isinstance(chart, Exception):
+                raise chart
+            yield filename, chart
+    finally:
+        stop.set()
+
+
+def iter_chart_files(filenames, manifest, counts):
+    # Drops files that don't need converting, counting them in counts
+    for filename in filenames:
+        counts['found'] += 1
+        if '.chart' not in filename:
+            logger.warning("Skipping file %s (not a .chart)", filename)
+            continue
+        if manifest and manifest.is_unchanged(filename):
+            logger.debug("Skipping unchanged file %s", filename)
+            counts['unchanged'] += 1
+            continue
+        yield filename
+
+
+def convert_file(filename, args, chart=None):
+    # Returns (True if the file was converted, profile dict or None).
+    # chart is the file from read_chart if it has been read already.
+    profile = Profile(filename)
+    if chart is None:
+        try:
+            with profile.phase('read'):
+                chart = read_chart(filename)
+        except OSError as e:
+            # e.g. a broken symlink, the other files are still converted
+            if isinstance(e, IsADirectoryError) and not args.batch:
+                logger.error("%s is a directory, use --batch option to parse directories", filename)
+            else:
+                logger.error("Can't read %s: %s", filename, e)
+            return False, profile.as_dict()
+    else:
+        profile.timings['read'] += chart.read_seconds
+    profile.count('lines', chart.line_count)
+
+    ok = False
+    parser = None
+    try:
+        logger.info("Parsing file %s", filename)
+        parser = Parser(args, profile=profile)
+        parser.parse_file(chart)
+        if args.in_place:
+            # Try to backup original file if backup doesn't exist
+            if not os.path.exists(filename + '.bak'):
+                shutil.copyfile(filename, filename + '.bak')
+                logger.info("Backed up file to %s", filename + '.bak')
+            parser.write_file(filename)
+            logger.info("Wrote file %s", filename)
         else:
-            return [self.path]
+            new_path = filename.replace('.chart', '_easy.chart')
+            parser.write_file(new_path)
+            logger.info("Wrote file %s", new_path)
+        ok = True
+    except Exception as e:
+        logger.exception("Error parsing file %s: %s", filename, e)
+    finally:
+        if parser is not None:
+            parser.close()
+        chart.close()
+
+    if getattr(args, 'profile', False):
+        profile.log()
+    logger.info("")
+    return ok, profile.as_dict()
+
+
+ANALYSIS_FIELDS = (
+    'file', 'part', 'resolution', 'tempo_changes', 'ts_changes', 'has_easy', 'has_medium', 'has_hard',
+    'notes', 'chords', 'seconds', 'nps', 'peak_nps', 'doublekick_rewrites', 'error',
+)
+
+
+def analyze_file(filename, args, chart=None):
+    # Returns (True if the file could be read, list of ANALYSIS_FIELDS
+    # dicts, one per Expert part). Nothing is written.
+    try:
+        if chart is None:
+            chart = read_chart(filename)
+    except OSError as e:
+        logger.error("Can't read %s: %s", filename, e)
+        return False, [{'file': filename, 'error': str(e)}]
+    try:
+        logger.debug("Analyzing file %s", filename)
+        parser = Parser(args)
+        parser.parse_header(chart)
+        names = {section.name for section in chart.sections}
+        rows = []
+        for section in chart.sections:
+            if not section.name.startswith('[Expert'):
+                continue
+            row = {
+                'file': filename,
+                'part': section.name,
+                'resolution': parser.resolution,
+                'tempo_changes': max(len(parser.bpm_for_ms) - 1, 0),
+                'ts_changes': max(len(parser.ts_for_ms) - 1, 0),
+            }
+            for diff in ('easy', 'medium', 'hard'):
+                row['has_' + diff] = section.name.replace('Expert', diff.capitalize()) in names
+            row.update(parser.analyze_part(section.name, section.events))
+            rows.append(row)
+        return True, rows
+    except Exception as e:
+        logger.exception("Error analyzing file %s: %s", filename, e)
+        return False, [{'file': filename, 'error': str(e)}]
+    finally:
+        chart.close()
+
+
+def write_analysis_report(filename, rows):
+    # CSV for .csv files, JSON otherwise
+    if filename.lower().endswith('.csv'):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=ANALYSIS_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(filename, 'w') as f:
+            json.dump(rows, f, indent=2)
+    logger.info("Wrote analysis of %s parts to %s", len(rows), filename)
+
+
+@dataclass
+class ConvertOptions:
+    # Options for convert(), same meaning as the command line options
+    easy: bool = False
+    medium: bool = False
+    hard: bool = False
+    bpm_multiplier: float = 1
+    doublekick: int = 0
+    force: bool = False
+    rules: Optional[Union[dict, str]] = None
+    numpy: bool = False
+    section_jobs: int = 1
+
+
+@dataclass
+class ConversionResult:
+    output: Union[str, bytes]
+    # New parts and their note counts
+    parts: Dict[str, int] = field(default_factory=dict)
+    replaced_parts: List[str] = field(default_factory=list)
+    skipped_parts: List[str] = field(default_factory=list)
+    profile: dict = field(default_factory=dict)
+
+
+def convert(data, options=None):
+    # Convert a chart in memory. data is the chart as str or bytes, the
+    # output has the same type. Nothing is read from or written to disk,
+    # unless options.rules is a filename.
+    if options is None:
+        options = ConvertOptions()
+    is_bytes = isinstance(data, (bytes, bytearray))
+
+    profile = Profile()
+    with profile.phase('read'):
+        chart = index_chart(data if is_bytes else data.encode(CHART_ENCODING, CHART_ENCODING_ERRORS))
+    profile.count('lines', chart.line_count)
+    parser = Parser(options, profile=profile)
+    parser.parse_file(chart)
+    output = io.BytesIO()
+    parser.write(output)
+    output = output.getvalue()
+
+    return ConversionResult(
+        output=output if is_bytes else output.decode(CHART_ENCODING, CHART_ENCODING_ERRORS),
+        parts={
+            partname: count_notes(events)
+            for partname, events in parser.new_parts.items()
+        },
+        replaced_parts=parser.replaced_parts,
+        skipped_parts=parser.skipped_parts,
+        profile=profile.as_dict(),
+    )
+
+
+class RecordCollector(logging.Handler):
+    # Keeps log records of a worker process so they can be sent back to
+    # the main process and logged there in file order
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # Make the record picklable
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        self.records.append(record)
+
+
+class EventBus():
+    # Log records and progress of main(), for a renderer that drains them
+    # in batches at its own refresh rate instead of drawing every event.
+    # Events are (kind, data) tuples:
+    #   ('log', {'record': LogRecord})
+    #   ('progress', {'done': int, 'total': int or None, 'filename': str or None})
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def publish(self, kind, **data):
+        self.queue.put((kind, data))
+
+    def drain(self):
+        # All pending events, with only the latest progress event kept
+        events = []
+        progress = None
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'progress':
+                progress = event
+            else:
+                events.append(event)
+        if progress:
+            events.append(progress)
+        return events
+
+
+class EventBusHandler(logging.Handler):
+    def __init__(self, bus):
+        logging.Handler.__init__(self)
+        self.bus = bus
+
+    def emit(self, record):
+        self.bus.publish('log', record=record)
+
+
+class CLIRenderer():
+    # Prints the events of a bus from a thread, a batch of log lines per
+    # write. On a terminal the progress is kept on a status line below.
+    REFRESH_SECONDS = 0.1
+
+    def __init__(self, bus, stream=None):
+        self.bus = bus
+        self.stream = stream or sys.stderr
+        self.formatter = logging.Formatter("[%(levelname)s] %(message)s")
+        self.show_status = self.stream.isatty()
+        self.status = ''
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="easygen-renderer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.render(clear_status=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.REFRESH_SECONDS):
+            self.render()
+
+    def render(self, clear_status=False):
+        with self.lock:
+            lines = []
+            status = self.status
+            for kind, data in self.bus.drain():
+                if kind == 'log':
+                    lines.append(self.formatter.format(data['record']) + '\n')
+                elif kind == 'progress' and self.show_status:
+                    if data['total']:
+                        status = '{}/{} files'.format(data['done'], data['total'])
+                    else:
+                        status = '{} files'.format(data['done'])
+            if clear_status:
+                status = ''
+            if not lines and status == self.status:
+                return
+            output = []
+            if self.status:
+                output.append('\r' + ' ' * len(self.status) + '\r')
+            output.extend(lines)
+            output.append(status)
+            self.status = status
+            self.stream.write(''.join(output))
+            self.stream.flush()
+
+    def pausing(self, func):
+        # Wraps a function that writes to the terminal, like ask(), so
+        # everything logged before it is printed first
+        def wrapper(*args, **kwargs):
+            self.render(clear_status=True)
+            return func(*args, **kwargs)
+        return wrapper
+
+
+@contextmanager
+def collect_log_records():
+    # Keep the records logged inside the block instead of printing them.
+    # Used in worker processes, which may be forked with main()'s
+    # EventBusHandler: nothing drains that copy of the bus, so it's removed.
+    for handler in list(logger.handlers):
+        if isinstance(handler, EventBusHandler):
+            logger.removeHandler(handler)
+    collector = RecordCollector()
+    collector.setFormatter(logging.Formatter())
+    logger.addHandler(collector)
+    logger.propagate = False
+    try:
+        yield collector.records
+    finally:
+        logger.removeHandler(collector)
+        logger.propagate = True
+
+
+def file_worker(func, filename, args):
+    # Runs func(filename, args) in a --jobs worker process
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    # The files are already converted in parallel
+    args = copy.copy(args)
+    args.section_jobs = 1
+    with collect_log_records() as records:
+        ok, result = func(filename, args)
+    return ok, result, records
+
+
+# Parser of a --section_jobs worker process, with the tempo map of the
+# chart being converted
+section_parser = None
+
+
+def init_section_worker(options, resolution, sync_track, log_level):
+    global section_parser
+    logger.setLevel(log_level)
+    section_parser = Parser(options)
+    section_parser.resolution = resolution
+    section_parser.sync_track = sync_track
+    section_parser.handle_sync_track()
+
+
+def reduce_section_worker(section):
+    # Returns (new parts, profile dict, log records) of one Expert part
+    section_parser.new_parts = {}
+    section_parser.profile = Profile()
+    with collect_log_records() as records:
+        section_parser.parse_expert_part(section.name, section_parser.section_events(section))
+    return section_parser.new_parts, section_parser.profile.as_dict(), records
+
+
+def iter_conversions(file_list, args, func=convert_file):
+    # Yields (filename, True/False, profile dict) for each file in
+    # file_list, in order. file_list can be a generator, files are
+    # converted as they come. func is convert_file or analyze_file.
+    jobs = getattr(args, 'jobs', 1)
+    if jobs is None or jobs <= 0:
+        jobs = os.cpu_count() or 1
+    if getattr(args, 'cprofile', None) and jobs != 1:
+        logger.warning("--cprofile only profiles a single process, ignoring --jobs")
+        jobs = 1
+    if jobs == 1 or not args.batch:
+        for filename, chart in read_ahead(file_list):
+            ok, result = func(filename, args, chart=chart)
+            yield filename, ok, result
+        return
+
+    logger.info("Converting files using %s processes", jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Keep a few files per process queued, results are yielded in
+        # the order the files were found
+        pending = deque()
+        file_iter = iter(file_list)
+        try:
+            while True:
+                for filename in itertools.islice(file_iter, jobs * 2 - len(pending)):
+                    pending.append((filename, executor.submit(file_worker, func, filename, args)))
+                if not pending:
+                    break
+                filename, future = pending.popleft()
+                ok, result, records = future.result()
+                for record in records:
+                    logger.handle(record)
+                yield filename, ok, result
+        finally:
+            # Stopped early, don't start the queued files
+            for filename, future in pending:
+                future.cancel()
+
+
+class Manifest():
+    # Remembers the files converted by --batch runs in a library, so
+    # reruns can skip files whose output would be identical.
+    FILENAME = '.easygen_manifest.json'
+    VERSION = 1
+
+    def __init__(self, root, args):
+        self.root = root
+        self.path = os.path.join(root, self.FILENAME)
+        self.in_place = bool(args.in_place)
+        self.options = self.options_key(args)
+        self.files = {}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.files = data['files']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, AttributeError):
+            logger.warning("Ignoring invalid manifest %s", self.path)
+
+    @staticmethod
+    def options_key(args):
+        # Everything that changes the output of a file
+        parts = [diff for diff in ('easy', 'medium', 'hard') if getattr(args, diff)]
+        return {
+            'bpm_multiplier': args.bpm_multiplier,
+            'doublekick': args.doublekick,
+            'parts': parts or ['easy', 'medium', 'hard'],
+            'force': bool(args.force),
+            'in_place': bool(args.in_place),
+            # The rules in effect, DIFFICULTY_RULES may have been edited
+            'rules': hashlib.sha1(
+                json.dumps(load_rules(getattr(args, 'rules', None)), sort_keys=True).encode()
+            ).hexdigest(),
+            'version': CONVERTER_VERSION,
+        }
+
+    @staticmethod
+    def file_hash(filename):
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def key(self, filename):
+        return os.path.relpath(filename, self.root)
+
+    def is_unchanged(self, filename):
+        entry = self.files.get(self.key(filename))
+        if not entry or entry['options'] != self.options:
+            return False
+        if not self.in_place and not os.path.exists(filename.replace('.chart', '_easy.chart')):
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime_ns']:
+            return True
+        # Touched but maybe not modified
+        if self.file_hash(filename) != entry['sha1']:
+            return False
+        entry['mtime_ns'] = stat.st_mtime_ns
+        return True
+
+    def record(self, filename):
+        # With --in_place this records the converted file, so the next run
+        # sees it as unchanged
+        stat = os.stat(filename)
+        self.files[self.key(filename)] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha1': self.file_hash(filename),
+            'options': self.options,
+        }
+
+    def save(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, uuid.uuid4().hex[:8])
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.VERSION, 'files': self.files}, f)
+        os.replace(tmp_path, self.path)
+
+
+WATCH_INTERVAL = 0.2
+WATCH_DEBOUNCE = 0.3
+
+
+class ChartWatcher():
+    # Polls the files of a FileFinder for --watch. A changed file is
+    # returned once it has stayed the same for debounce seconds, so an
+    # editor saving several times in a row converts it only once. Outputs
+    # (_easy.chart, .bak, .tmp) are never listed by FileFinder.
+
+    def __init__(self, filefinder, debounce=WATCH_DEBOUNCE):
+        self.filefinder = filefinder
+        self.debounce = debounce
+        self.known = dict(filefinder.iter_stats())
+        self.pending = {}  # filename -> (stat, when it last changed)
+
+    def poll(self, now=None):
+        # Returns the files to convert now
+        if now is None:
+            now = time.monotonic()
+        stats = dict(self.filefinder.iter_stats())
+        for filename in list(self.known):
+            if filename not in stats:
+                del self.known[filename]
+        ready = []
+        for filename, stat in stats.items():
+            if self.known.get(filename) == stat:
+                self.pending.pop(filename, None)
+                continue
+            pending = self.pending.get(filename)
+            if pending is None or pending[0] != stat:
+                self.pending[filename] = (stat, now)
+            elif now - pending[1] >= self.debounce:
+                del self.pending[filename]
+                self.known[filename] = stat
+                ready.append(filename)
+        for filename in list(self.pending):
+            if filename not in stats:
+                del self.pending[filename]
+        return ready
+
+    def written(self, filename):
+        # Our own --in_place write isn't a change
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return
+        self.known[filename] = (stat.st_mtime_ns, stat.st_size)
+
+
+def watch_files(filefinder, args, manifest, progress_func, cancel_event, events):
+    # --watch: convert charts again as they are saved, until cancelled
+    watcher = ChartWatcher(filefinder)
+    logger.info("Watching %s for changes, press Ctrl+C to stop", filefinder.path)
+    counts = defaultdict(int)
+    done = 0
+    try:
+        while cancel_event is None or not cancel_event.is_set():
+            for filename in iter_chart_files(watcher.poll(), manifest, counts):
+                ok, _ = convert_file(filename, args)
+                if args.in_place:
+                    watcher.written(filename)
+                if ok and manifest:
+                    manifest.record(filename)
+                    manifest.save()
+                done += 1
+                events.publish('progress', done=done, total=None, filename=filename)
+                if progress_func:
+                    progress_func(done, None, filename)
+            if cancel_event is not None:
+                cancel_event.wait(WATCH_INTERVAL)
+            else:
+                time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stopped watching, converted %s files", done)
+
+
+def write_profile_report(filename, profiles):
+    totals = {
+        'seconds': defaultdict(float),
+        'counters': defaultdict(int),
+    }
+    for profile in profiles:
+        for phase, seconds in profile['seconds'].items():
+            totals['seconds'][phase] += seconds
+        for name, value in profile['counters'].items():
+            totals['counters'][name] += value
+    with open(filename, 'w') as f:
+        json.dump({'files': profiles, 'totals': totals}, f, indent=2)
+    logger.info("Wrote profile report to %s", filename)
 
 
 def ask(question):
     return input(question + ' [y/n] ').lower().startswith('y')
 
 
-def main(argument_parser_class=argparse.ArgumentParser, args=None, ask_func=ask, dont_exit=False):
+def analyze_files(filefinder, args, dont_exit, cancel_event, events):
+    # --analyze: stream the files through analyze_file and write the report
+    rows = []
+    done = 0
+    failed = 0
+    analyses = iter_conversions(filefinder.iter_files(), args, func=analyze_file)
+    try:
+        for filename, ok, file_rows in analyses:
+            rows.extend(file_rows)
+            done += 1
+            if not ok:
+                failed += 1
+            events.publish('progress', done=done, total=None, filename=filename)
+            if cancel_event is not None and cancel_event.is_set():
+                logger.warning("Cancelled")
+                break
+    finally:
+        analyses.close()
+    if done == 0:
+        logger.error("No files found")
+        if dont_exit:
+            return
+        exit(1)
+    write_analysis_report(args.analyze, rows)
+    logger.info("Analyzed %s files, %s failed", done, failed)
+    logger.info("Done!")
+
+
+def main(
+    argument_parser_class=argparse.ArgumentParser, args=None, ask_func=ask, dont_exit=False,
+    progress_func=None, cancel_event=None, events=None
+):
+    # Logs and progress are published to events, an EventBus. Without one
+    # they are printed by a CLIRenderer. progress_func(done, total,
+    # filename) is also called after each converted file, total is None if
+    # it isn't known. Setting cancel_event stops the conversion before the
+    # next file.
     if not args:
         args = parse_args(argument_parser_class=argument_parser_class)
+    renderer = None
+    if events is None:
+        events = EventBus()
+        renderer = CLIRenderer(events)
+        renderer.start()
+        ask_func = renderer.pausing(ask_func)
+    handler = EventBusHandler(events)
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        return convert_files(args, ask_func, dont_exit, progress_func, cancel_event, events)
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = True
+        if renderer:
+            renderer.stop()
+
+
+def convert_files(args, ask_func, dont_exit, progress_func, cancel_event, events):
     logger.warning("Parsed args: %s", args.__dict__)
     if args.verbose:
         logger.setLevel(logging.DEBUG)
@@ -639,72 +2344,102 @@ def main(argument_parser_class=argparse.ArgumentParser, args=None, ask_func=ask,
         logger.setLevel(logging.INFO)
 
     filefinder = FileFinder(args)
-    file_list = list(filefinder.list_files())
-    if len(file_list) == 0:
-        logger.error("No files found")
-        if dont_exit:
-            return
-        exit(1)
-    if not any(_file.endswith('.chart') for _file in file_list):
+    if not args.batch and not filefinder.path.endswith('.chart'):
         logger.error("No .chart files found (Use --batch if path is a directory)")
         if dont_exit:
             return
         exit(1)
-    if len(file_list) > 1:
-        # Print files and ask if they are ok
-        logger.info("Found {} files:".format(len(file_list)))
-        for i, file in enumerate(file_list):
-            logger.info("{}".format(file))
-        logger.info("")
-        if not ask_func("Are these files ok?"):
-            logger.error("NO")
+    if getattr(args, 'analyze', None):
+        return analyze_files(filefinder, args, dont_exit, cancel_event, events)
+
+    file_count = None if args.batch else 1
+    if args.batch and not getattr(args, 'yes', False):
+        # Print files and ask if they are ok. Only the count is kept, the
+        # files are found again while converting.
+        logger.info("Found files:")
+        file_count = filefinder.count_files(log=True)
+        if file_count == 0:
+            logger.error("No files found")
             if dont_exit:
                 return
             exit(1)
-
-    if args.in_place:
-        if not ask_func("Will replace existing files. ARE YOU SURE??"):
+        logger.info("Found {} files".format(file_count))
+        logger.info("")
+        if file_count > 1 and not ask_func("Are these files ok?"):
             logger.error("NO")
             if dont_exit:
                 return
             exit(1)
 
-    for filename in file_list:
-        if '.chart' not in filename:
-            logger.warning("Skipping file %s (not a .chart)", filename)
-            continue
-        try:
-            with open(filename, 'r') as f:
-                lines = [line.strip().replace('\ufeff', '') for line in f.readlines()]
-        except IsADirectoryError:
-            logger.error("{} is a directory, use --batch option to parse directories".format(filename))
+    if args.in_place and not getattr(args, 'yes', False):
+        if not ask_func("Will replace existing files. ARE YOU SURE??"):
+            logger.error("NO")
             if dont_exit:
                 return
             exit(1)
 
-        try:
-            logger.info("Parsing file %s", filename)
-            parser = Parser(args)
-            parser.parse_file(lines)
-            if args.in_place:
-                # Try to backup original file if backup doesn't exist
-                if not os.path.exists(filename + '.bak'):
-                    with open(filename + '.bak', 'w') as f:
-                        f.write('\n'.join(lines))
-                    logger.info("Backed up file to %s", filename + '.bak')
-                parser.write_file(filename)
-                logger.info("Wrote file %s", filename)
+    manifest = None
+    if args.batch and not getattr(args, 'no_manifest', False):
+        manifest = Manifest(filefinder.path, args)
+
+    counts = defaultdict(int)
+    chart_files = iter_chart_files(filefinder.iter_files(), manifest, counts)
+
+    converted = 0
+    failed = 0
+    cancelled = False
+    profiles = []
+    cprofile = None
+    if getattr(args, 'cprofile', None):
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+    conversions = iter_conversions(chart_files, args)
+    try:
+        for filename, ok, profile in conversions:
+            profiles.append(profile)
+            if ok:
+                converted += 1
+                if manifest:
+                    manifest.record(filename)
             else:
-                new_path = filename.replace('.chart', '_easy.chart')
-                parser.write_file(new_path)
-                logger.info("Wrote file %s", new_path)
-        except Exception as e:
-            logger.exception("Error parsing file %s: %s", filename, e)
-
-        logger.info("")
-
+                failed += 1
+            done = converted + failed + counts['unchanged']
+            events.publish('progress', done=done, total=file_count, filename=filename)
+            if progress_func:
+                progress_func(done, file_count, filename)
+            if cancel_event is not None and cancel_event.is_set():
+                cancelled = True
+                break
+    finally:
+        conversions.close()
+        if manifest and counts['found']:
+            manifest.save()
+        if cprofile:
+            cprofile.disable()
+            cprofile.dump_stats(args.cprofile)
+            logger.info("Wrote cProfile stats to %s", args.cprofile)
+
+    if getattr(args, 'profile_report', None):
+        write_profile_report(args.profile_report, profiles)
+
+    done = converted + failed + counts['unchanged']
+    events.publish('progress', done=done, total=file_count, filename=None)
+    if progress_func:
+        progress_func(done, file_count, None)
+    watch = getattr(args, 'watch', False)
+    if cancelled:
+        logger.warning("Cancelled")
+    elif counts['found'] == 0 and not watch:
+        logger.error("No files found")
+        if dont_exit:
+            return
+        exit(1)
+    logger.info("Converted %s files, %s failed, %s unchanged", converted, failed, counts['unchanged'])
     logger.info("Done!")
+    if watch and not cancelled:
+        watch_files(filefinder, args, manifest, progress_func, cancel_event, events)
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import dataclasses
+import json
+import logging
+import os
+import signal
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from EasyChartGenerator.easygen import ConvertOptions, convert, load_rules
+
+logging.basicConfig(
+    format="[%(levelname)s] %(message)s",
+)
+
+
+logger = logging.getLogger("easygen.server")
+
+MAX_BODY_SIZE = 64 << 20
+MAX_HEADER_COUNT = 100
+
+BOOLEAN_OPTIONS = ('easy', 'medium', 'hard', 'force', 'numpy')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Keep the converter running and convert charts sent over HTTP',
+    )
+    parser.add_argument('--host', help='Address to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on', type=int, default=8765)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of --host/--port')
+    parser.add_argument('--workers', help='Conversion processes (0 = one per CPU)', type=int, default=0)
+    parser.add_argument(
+        '--max_pending', help='Max jobs converting or waiting, more are rejected with 503',
+        type=int, default=64
+    )
+    parser.add_argument('-v', '--verbose', help='Verbose logs', action="store_true")
+    return parser.parse_args()
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+def parse_options(query):
+    # Query string -> ConvertOptions, e.g. ?doublekick=150&easy=1
+    values = {key: value[-1] for key, value in parse_qs(query).items()}
+    kwargs = {}
+    try:
+        for key, value in values.items():
+            if key in BOOLEAN_OPTIONS:
+                kwargs[key] = value.lower() in ('1', 'true', 'yes', 'on')
+            elif key == 'bpm_multiplier':
+                kwargs[key] = float(value)
+            elif key == 'doublekick':
+                kwargs[key] = int(value)
+            elif key == 'rules':
+                # Only inline rules, the server never reads files for a client
+                kwargs[key] = json.loads(value)
+                if not isinstance(kwargs[key], dict):
+                    raise ValueError("rules must be a JSON object")
+                # Invalid rules are the client's error, not a failed job
+                load_rules(kwargs[key])
+            else:
+                raise ValueError("Unknown option {}".format(key))
+    except (AttributeError, TypeError) as e:
+        raise HTTPError(400, "Invalid rules: {}".format(e))
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    return ConvertOptions(**kwargs)
+
+
+def run_job(data, options):
+    # Runs in a worker process
+    started = time.perf_counter()
+    result = convert(data, options)
+    ret = dataclasses.asdict(result)
+    # The chart's bytes as they are, charts aren't always valid UTF-8
+    ret['output'] = base64.b64encode(result.output).decode('ascii')
+    ret['seconds'] = time.perf_counter() - started
+    return ret
+
+
+def init_worker(level):
+    # Ctrl+C is handled by the main process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger("easygen").setLevel(level)
+
+
+def warm_up():
+    return os.getpid()
+
+
+class ConversionServer():
+
+    def __init__(self, workers=0, max_pending=64, log_level=logging.WARNING):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_worker, initargs=(log_level,)
+        )
+        self.max_pending = max_pending
+        self.pending = 0
+        self.converted = 0
+        self.failed = 0
+
+    def warm_up(self):
+        # Start the worker processes now instead of on the first job
+        for future in [self.executor.submit(warm_up) for _ in range(self.workers)]:
+            future.result()
+
+    async def convert(self, data, options):
+        if self.pending >= self.max_pending:
+            raise HTTPError(503, "Too many pending jobs")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            ret = await loop.run_in_executor(self.executor, run_job, data, options)
+        except HTTPError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            logger.exception("Conversion failed")
+            raise HTTPError(500, "Conversion failed: {}".format(e))
+        finally:
+            self.pending -= 1
+        self.converted += 1
+        return ret
+
+    def status(self):
+        return {
+            'status': 'ok',
+            'pending': self.pending,
+            'converted': self.converted,
+            'failed': self.failed,
+        }
+
+    async def handle_request(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/health':
+            return self.status()
+        if url.path != '/convert':
+            raise HTTPError(404, "Unknown path {}".format(url.path))
+        if method != 'POST':
+            raise HTTPError(405, "Use POST")
+        options = parse_options(url.query)
+        if not body:
+            raise HTTPError(400, "No chart in the request body")
+        return await self.convert(body, options)
+
+    async def read_request(self, reader):
+        # Returns (method, target, headers, body) or None on a closed
+        # connection
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HTTPError(400, "Invalid request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADER_COUNT:
+                raise HTTPError(400, "Too many headers")
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            # Not supported, the chart has to be sent with a Content-Length
+            raise HTTPError(411, "Chunked uploads aren't supported, send a Content-Length")
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, "Chart is too large")
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    async def write_response(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode('utf-8')
+        writer.write((
+            "HTTP/1.1 {} {}\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: {}\r\n"
+            "Connection: {}\r\n"
+            "\r\n"
+        ).format(status, REASONS[status], len(body), 'keep-alive' if keep_alive else 'close').encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    method, target, headers, body = request
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    payload = await self.handle_request(method, target, body)
+                    status = 200
+                except HTTPError as e:
+                    status = e.status
+                    payload = {'error': e.message}
+                logger.debug("%s %s", status, payload.get('error', ''))
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, socket_path=None):
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+            logger.info("Listening on %s", socket_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+            logger.info("Listening on http://%s:%s", host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    args = parse_args()
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    server = ConversionServer(
+        workers=args.workers, max_pending=args.max_pending,
+        log_level=logging.DEBUG if args.verbose else logging.WARNING,
+    )
+    server.warm_up()
+    try:
+        asyncio.run(server.serve(host=args.host, port=args.port, socket_path=args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from EasyChartGenerator import easygen
+from benchmarks.run import make_options
+from benchmarks.synthetic import SyntheticChart
+
+
+INSTRUMENTS = ('Single', 'DoubleBass', 'DoubleRhythm', 'Keys', 'Drums')
+
+
+def measure(filename, options):
+    # (peak traced bytes, seconds) of converting filename
+    tracemalloc.start()
+    started = time.perf_counter()
+    ok, _ = easygen.convert_file(filename, options)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if not ok:
+        raise SystemExit("Converting {} failed".format(filename))
+    return peak, seconds
+
+
+def write_largest_part(filename, part_filename):
+    # The chart with only its largest Expert part, which is what
+    # --low_memory should need memory for
+    chart = easygen.read_chart(filename)
+    try:
+        expert_sections = [
+            section for section in chart.sections if section.name.startswith('[Expert')
+        ]
+        largest = max(expert_sections, key=lambda section: section.raw_end - section.raw_start)
+        with open(part_filename, 'wb') as f:
+            for section in chart.sections:
+                if section.name.startswith('[Expert') and section is not largest:
+                    continue
+                f.write(chart.buffer[section.raw_start:section.raw_end])
+                f.write(b'\n')
+        return largest.name
+    finally:
+        chart.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that --low_memory peak memory is bounded by the largest Expert part'
+    )
+    parser.add_argument('--measures', type=int, default=2000, help='Length of the synthetic chart')
+    parser.add_argument('--instruments', nargs='+', default=list(INSTRUMENTS))
+    parser.add_argument('--density', type=float, default=4.0)
+    parser.add_argument(
+        '--tolerance', type=float, default=1.25,
+        help='Allowed peak as a multiple of converting the largest part alone'
+    )
+    args = parser.parse_args()
+
+    easygen.logger.setLevel(logging.WARNING)
+
+    chart = SyntheticChart(measures=args.measures, instruments=tuple(args.instruments), density=args.density)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'huge.chart')
+        part_filename = os.path.join(tmp_dir, 'part.chart')
+        with open(filename, 'w') as f:
+            f.write(chart.text())
+        largest = write_largest_part(filename, part_filename)
+
+        bound, _ = measure(part_filename, make_options(in_place=False, low_memory=False))
+        full, full_seconds = measure(filename, make_options(in_place=False, low_memory=False))
+        low, low_seconds = measure(filename, make_options(in_place=False, low_memory=True))
+        size = os.path.getsize(filename)
+
+    print("chart        {:>9} notes  {:.1f} MiB  {} Expert parts".format(
+        chart.note_count, size / (1 << 20), len(args.instruments)
+    ))
+    print("largest part {:>9}  peak {:.1f} MiB".format(largest, bound / (1 << 20)))
+    print("default      peak {:.1f} MiB  {:.2f}s".format(full / (1 << 20), full_seconds))
+    print("low_memory   peak {:.1f} MiB  {:.2f}s".format(low / (1 << 20), low_seconds))
+
+    limit = bound * args.tolerance
+    if low > limit:
+        print("FAIL: --low_memory peak {:.1f} MiB is over {:.1f} MiB ({}x the largest part)".format(
+            low / (1 << 20), limit / (1 << 20), args.tolerance
+        ))
+        sys.exit(1)
+    print("OK: --low_memory peak is {:.2f}x the largest part".format(low / bound))
+
+
+if __name__ == '__main__':
+    main()
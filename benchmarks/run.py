@@ -0,0 +1,172 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from EasyChartGenerator import easygen
+from benchmarks.synthetic import SyntheticChart
+
+
+SCENARIOS = {
+    'small': {
+        'chart': {'measures': 100},
+        'options': {},
+    },
+    'dense': {
+        'chart': {'measures': 300, 'density': 6.0, 'chord_rate': 0.4},
+        'options': {},
+    },
+    'tempo_heavy': {
+        'chart': {'measures': 300, 'tempo_changes': 800, 'ts_changes': 200},
+        'options': {},
+    },
+    'doublekick': {
+        'chart': {'measures': 400, 'instruments': ('Drums',), 'density': 4.0, 'doublekick_rate': 0.5},
+        'options': {'doublekick': 150, 'force': True},
+    },
+    'full_band': {
+        'chart': {'measures': 1500, 'instruments': ('Single', 'DoubleBass', 'DoubleRhythm', 'Keys', 'Drums')},
+        'options': {},
+    },
+}
+
+PHASES = ('tokenize', 'parse', 'write')
+
+
+def make_options(**options):
+    defaults = {
+        'force': False,
+        'bpm_multiplier': 1,
+        'doublekick': 0,
+        'easy': False,
+        'medium': False,
+        'hard': False,
+        'rules': None,
+        'numpy': False,
+    }
+    defaults.update(options)
+    return argparse.Namespace(**defaults)
+
+
+def convert(input_filename, options, output_filename, timings=None):
+    started = time.perf_counter()
+    chart = easygen.read_chart(input_filename)
+    tokenized = time.perf_counter()
+    parser = easygen.Parser(options)
+    parser.parse_file(chart)
+    parsed = time.perf_counter()
+    parser.write_file(output_filename)
+    written = time.perf_counter()
+    if timings is not None:
+        timings['tokenize'].append(tokenized - started)
+        timings['parse'].append(parsed - tokenized)
+        timings['write'].append(written - parsed)
+    return parser
+
+
+def run_scenario(name, scenario, repeat, numpy_engine, tmp_dir):
+    chart = SyntheticChart(**scenario['chart'])
+    text = chart.text()
+    options = make_options(numpy=numpy_engine, **scenario['options'])
+    input_filename = os.path.join(tmp_dir, name + '.chart')
+    output_filename = os.path.join(tmp_dir, name + '_easy.chart')
+    with open(input_filename, 'w') as f:
+        f.write(text)
+
+    timings = {phase: [] for phase in PHASES}
+    for _ in range(repeat):
+        parser = convert(input_filename, options, output_filename, timings)
+
+    tracemalloc.start()
+    convert(input_filename, options, output_filename)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    notes_out = {
+        partname: easygen.count_notes(events)
+        for partname, events in parser.new_parts.items()
+    }
+    best = {phase: min(values) for phase, values in timings.items()}
+    total = sum(best.values())
+    return {
+        'chart': {key: value for key, value in chart.options.items()},
+        'input_bytes': len(text.encode('utf-8')),
+        'input_lines': text.count('\n'),
+        'notes_in': chart.note_count,
+        'notes_out': notes_out,
+        'seconds': best,
+        'seconds_median': {phase: statistics.median(values) for phase, values in timings.items()},
+        'seconds_total': total,
+        'notes_per_second': chart.note_count / total if total else None,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def compare(results, baseline_filename):
+    with open(baseline_filename, 'r') as f:
+        baseline = json.load(f)['results']
+    print()
+    print("Compared to {} (>1 is faster now):".format(baseline_filename))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        speedups = ', '.join(
+            '{} {:.2f}x'.format(phase, old['seconds'][phase] / result['seconds'][phase])
+            for phase in PHASES if result['seconds'][phase]
+        )
+        memory = old['peak_memory_bytes'] / result['peak_memory_bytes']
+        print("  {:12} {}, memory {:.2f}x".format(name, speedups, memory))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark easygen on synthetic charts')
+    parser.add_argument('scenarios', nargs='*', help='Scenarios to run: {} (default: all)'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario, the fastest is reported')
+    parser.add_argument('--numpy', action='store_true', help='Use the NumPy engine')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the results to an earlier --output file')
+    args = parser.parse_args()
+
+    # Measure the converter, not log output
+    easygen.logger.setLevel(logging.WARNING)
+
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario {}".format(name))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in names:
+            result = run_scenario(name, SCENARIOS[name], args.repeat, args.numpy, tmp_dir)
+            results[name] = result
+            seconds = result['seconds']
+            print("{:12} {:>9} notes  tokenize {:.3f}s  parse {:.3f}s  write {:.3f}s  {:>9.0f} notes/s  peak {:.1f} MiB".format(
+                name, result['notes_in'], seconds['tokenize'], seconds['parse'], seconds['write'],
+                result['notes_per_second'], result['peak_memory_bytes'] / (1 << 20),
+            ))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'numpy': args.numpy,
+                'repeat': args.repeat,
+                'results': results,
+            }, f, indent=2)
+        print("Wrote {}".format(args.output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
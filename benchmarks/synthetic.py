@@ -0,0 +1,181 @@
+import argparse
+import random
+
+
+# Note lengths as fractions of a beat, weighted towards the common ones
+NOTE_SPACINGS = [(1, 4), (1, 4), (1, 2), (1, 2), (1, 1), (1, 3), (1, 8)]
+TIME_SIGNATURES = [3, 4, 4, 5, 6, 7]
+
+DEFAULTS = {
+    'seed': 0,
+    'measures': 200,
+    'resolution': 192,
+    'density': 2.0,  # Average notes per beat
+    'chord_rate': 0.2,
+    'tempo_changes': 10,
+    'ts_changes': 3,
+    'cymbal_rate': 0.3,
+    'accent_rate': 0.1,
+    'ghost_rate': 0.05,
+    'doublekick_rate': 0.1,  # Share of measures with fast 16th kick runs
+    'sustain_rate': 0.1,
+    'instruments': ('Single', 'Drums'),
+}
+
+
+class SyntheticChart():
+    # Deterministic .chart generator. The same options always produce the
+    # same chart, so runs on different commits can be compared.
+
+    def __init__(self, **options):
+        unknown = set(options) - set(DEFAULTS)
+        if unknown:
+            raise TypeError("Unknown options: {}".format(', '.join(sorted(unknown))))
+        self.options = dict(DEFAULTS, **options)
+        self.note_count = 0
+
+    def beat_length(self):
+        return self.options['resolution']
+
+    def song_length(self):
+        return self.options['measures'] * 4 * self.beat_length()
+
+    def song_lines(self):
+        return [
+            'Name = "Synthetic {}"'.format(self.options['seed']),
+            'Artist = "easygen benchmarks"',
+            'Offset = 0',
+            'Resolution = {}'.format(self.options['resolution']),
+            'Player2 = bass',
+            'MusicStream = "song.ogg"',
+        ]
+
+    def sync_track_lines(self, rng):
+        events = [(0, 'TS 4'), (0, 'B 120000')]
+        length = self.song_length()
+        beat = self.beat_length()
+        for _ in range(self.options['tempo_changes']):
+            tick = rng.randrange(1, length // beat) * beat
+            events.append((tick, 'B {}'.format(rng.randint(60, 240) * 1000)))
+        for _ in range(self.options['ts_changes']):
+            tick = rng.randrange(1, length // beat) * beat
+            events.append((tick, 'TS {}'.format(rng.choice(TIME_SIGNATURES))))
+        events.sort(key=lambda event: event[0])
+        return ['{} = {}'.format(tick, value) for tick, value in events]
+
+    def events_lines(self):
+        measure = 4 * self.beat_length()
+        return [
+            '{} = E "section Part {}"'.format(tick, index + 1)
+            for index, tick in enumerate(range(0, self.song_length(), measure * 16))
+        ]
+
+    def note_ticks(self, rng):
+        beat = self.beat_length()
+        length = self.song_length()
+        tick = 0
+        while tick < length:
+            yield tick
+            numerator, denominator = rng.choice(NOTE_SPACINGS)
+            spacing = beat * numerator // denominator
+            # Scale the spacing towards the requested density
+            spacing = max(1, int(spacing * 2.0 / self.options['density']))
+            tick += spacing
+
+    def single_lines(self, rng):
+        options = self.options
+        beat = self.beat_length()
+        lines = []
+        for tick in self.note_ticks(rng):
+            if rng.random() < options['chord_rate']:
+                colors = sorted(rng.sample(range(5), rng.choice([2, 2, 3])))
+            else:
+                colors = [rng.choice([0, 1, 2, 3, 4, 7])]
+            length = 0
+            if rng.random() < options['sustain_rate']:
+                length = beat * rng.choice([1, 2])
+            for color in colors:
+                lines.append('{} = N {} {}'.format(tick, color, length))
+                self.note_count += 1
+            if rng.random() < 0.01:
+                lines.append('{} = S 2 {}'.format(tick, beat * 8))
+        return lines
+
+    def drums_lines(self, rng):
+        options = self.options
+        beat = self.beat_length()
+        measure = 4 * beat
+        lines = []
+        kick_ticks = set()
+        for tick in self.note_ticks(rng):
+            if rng.random() < options['chord_rate']:
+                colors = sorted(rng.sample(range(5), 2))
+            else:
+                colors = [rng.randrange(5)]
+            if 0 in colors:
+                kick_ticks.add(tick)
+            for color in colors:
+                lines.append('{} = N {} 0'.format(tick, color))
+                self.note_count += 1
+                if color in (2, 3, 4) and rng.random() < options['cymbal_rate']:
+                    lines.append('{} = N {} 0'.format(tick, color + 64))
+                if color in (1, 2, 3) and rng.random() < options['accent_rate']:
+                    lines.append('{} = N {} 0'.format(tick, color + 33))
+            if rng.random() < options['ghost_rate']:
+                lines.append('{} = N 40 0'.format(tick))
+
+        # Fast kick runs for --doublekick
+        for measure_start in range(0, self.song_length(), measure):
+            if rng.random() >= options['doublekick_rate']:
+                continue
+            for tick in range(measure_start, measure_start + measure, beat // 4):
+                if tick in kick_ticks:
+                    continue
+                lines.append('{} = N 0 0'.format(tick))
+                self.note_count += 1
+
+        lines.sort(key=lambda line: int(line.split(' ', 1)[0]))
+        return lines
+
+    def sections(self):
+        # (name, lines) in file order
+        rng = random.Random(self.options['seed'])
+        self.note_count = 0
+        yield '[Song]', self.song_lines()
+        yield '[SyncTrack]', self.sync_track_lines(rng)
+        yield '[Events]', self.events_lines()
+        for instrument in self.options['instruments']:
+            if instrument == 'Drums':
+                yield '[ExpertDrums]', self.drums_lines(rng)
+            else:
+                yield '[Expert{}]'.format(instrument), self.single_lines(rng)
+
+    def text(self):
+        lines = []
+        for name, section_lines in self.sections():
+            lines.append(name)
+            lines.append('{')
+            lines.extend('  ' + line for line in section_lines)
+            lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic .chart file')
+    parser.add_argument('filename')
+    for key, default in DEFAULTS.items():
+        if key == 'instruments':
+            parser.add_argument('--instruments', nargs='+', default=list(default))
+        else:
+            parser.add_argument('--' + key, type=type(default), default=default)
+    args = parser.parse_args()
+    options = vars(args)
+    filename = options.pop('filename')
+    chart = SyntheticChart(**options)
+    with open(filename, 'w') as f:
+        f.write(chart.text())
+    print("Wrote {} ({} expert notes)".format(filename, chart.note_count))
+
+
+if __name__ == '__main__':
+    main()
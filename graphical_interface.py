@@ -1,30 +1,37 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, ttk
 import argparse
 import logging
+import multiprocessing
+import os
+import queue
 import sys
-from EasyChartGenerator.easygen import main as easygen_main, parse_args
+import threading
+import time
+from EasyChartGenerator.easygen import main as easygen_main, parse_args, EventBus, EventBusHandler
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-class TextHandler(logging.Handler):
-    def __init__(self, text):
-        logging.Handler.__init__(self)
-        self.text = text
-
-    def emit(self, record):
-        msg = self.format(record)
-        self.text.insert(tk.END, msg + "\n")
-        self.text.see(tk.END)
-
 # Define the main GUI application
 class EasyChartGeneratorApp:
+    POLL_MS = 100
+
     def __init__(self, root):
         self.root = root
         self.root.title("Easy Chart Generator")
+        self.worker = None
+        self.cancel_event = threading.Event()
+        # Logs and progress from the worker, drawn by poll
+        self.events = EventBus()
+        self.formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        # (func, args, result, done) to run on the Tk thread
+        self.ui_calls = queue.Queue()
+        # (done, total, filename) from the worker
+        self.progress = None
+        self.started = None
 
         class TKInterAgrparser():
             tk_root = root
@@ -85,15 +92,110 @@ class EasyChartGeneratorApp:
                     # Set default value
                     getattr(self, dest).insert(0, kwargs.get("default"))
                     return
+                # Anything else is a plain text entry
+                tk.Label(self.tk_root, text=f"{dest}: {kwargs.get('help')}").grid(row=self.current_row, column=0, padx=10, pady=10)
+                self.current_row += 1
+                setattr(self, dest, tk.Entry(self.tk_root, width=50))
+                getattr(self, dest).grid(row=self.current_row, column=0)
 
         self.arg_parser_class = TKInterAgrparser
 
+    def call_in_ui(self, func, *args):
+        # Run func on the Tk thread and wait for the result
+        result = []
+        done = threading.Event()
+        self.ui_calls.put((func, args, result, done))
+        done.wait()
+        return result[0]
+
     def ask_func(self, msg):
-        return messagebox.askyesno("Question", msg)
+        return self.call_in_ui(messagebox.askyesno, "Question", msg)
 
     def run_main(self):
+        if self.worker and self.worker.is_alive():
+            return
         args = self.args.args_as_obj()
-        easygen_main(args=args, dont_exit=True, ask_func=self.ask_func)
+        self.cancel_event.clear()
+        self.progress = None
+        self.started = time.monotonic()
+        self.submit_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar.config(value=0)
+        self.status_label.config(text="Starting...")
+        self.worker = threading.Thread(target=self.run_worker, args=(args,), daemon=True)
+        self.worker.start()
+
+    def run_worker(self, args):
+        try:
+            easygen_main(
+                args=args, dont_exit=True, ask_func=self.ask_func,
+                cancel_event=self.cancel_event, events=self.events,
+            )
+        except Exception as e:
+            logger.exception("Conversion failed: %s", e)
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.cancel_button.config(state=tk.DISABLED)
+        self.status_label.config(text="Cancelling after the current file...")
+
+    def close(self):
+        self.cancel_event.set()
+        self.root.destroy()
+
+    def update_progress(self):
+        if self.progress is None:
+            return
+        done, total, filename = self.progress
+        elapsed = time.monotonic() - self.started
+        rate = done / elapsed if elapsed > 0 else 0
+        if total:
+            self.progress_bar.config(mode='determinate', maximum=total, value=done)
+            text = "{}/{} files, {:.1f} files/s".format(done, total, rate)
+        else:
+            self.progress_bar.config(mode='indeterminate')
+            self.progress_bar.step()
+            text = "{} files, {:.1f} files/s".format(done, rate)
+        if filename:
+            text += " - {}".format(os.path.basename(filename))
+        if self.cancel_event.is_set():
+            text += " - cancelling after the current file" if self.worker.is_alive() else " - cancelled"
+        self.status_label.config(text=text)
+
+    def render_events(self):
+        # All the log lines since the last poll are inserted at once
+        lines = []
+        for kind, data in self.events.drain():
+            if kind == 'log':
+                lines.append(self.formatter.format(data['record']) + "\n")
+            elif kind == 'progress':
+                self.progress = (data['done'], data['total'], data['filename'])
+        if lines:
+            self.output_text.insert(tk.END, ''.join(lines))
+            self.output_text.see(tk.END)
+
+    def poll(self):
+        # Runs on the Tk thread every POLL_MS. Logs are drawn before
+        # asking anything, so questions come after what was logged.
+        # A finished run is checked first so its last events are drawn.
+        finished = self.started is not None and not self.worker.is_alive()
+        self.render_events()
+        while True:
+            try:
+                func, args, result, done = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                result.append(func(*args))
+            finally:
+                done.set()
+        if self.started is not None:
+            self.update_progress()
+            if finished:
+                self.started = None
+                self.submit_button.config(state=tk.NORMAL)
+                self.cancel_button.config(state=tk.DISABLED)
+        self.root.after(self.POLL_MS, self.poll)
 
     def add_logic(self):
         # When args.filebutton is clicked, clear dir
@@ -117,20 +219,31 @@ class EasyChartGeneratorApp:
         self.args.in_place.set(True)
         
     def add_rest_of_ui(self):
-        submit_button = tk.Button(root, text="Submit", command=self.run_main)
-        submit_button.grid(row=30, columnspan=2, pady=10)
+        last_row = self.args.current_row
+        buttons = tk.Frame(self.root)
+        buttons.grid(row=last_row + 1, columnspan=2, pady=10)
+        self.submit_button = tk.Button(buttons, text="Submit", command=self.run_main)
+        self.submit_button.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = tk.Button(buttons, text="Cancel", command=self.cancel, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+
+        self.progress_bar = ttk.Progressbar(self.root, length=600, mode='determinate')
+        self.progress_bar.grid(row=last_row + 2, columnspan=2)
+        self.status_label = tk.Label(self.root, text="")
+        self.status_label.grid(row=last_row + 3, columnspan=2)
 
         # Add a text box to display the output
-        output_text = tk.Text(root, height=20, width=100)
-        output_text.grid(row=31, columnspan=2)
-        # Add new logging handler to redirect stdout to the text box
+        self.output_text = tk.Text(self.root, height=20, width=100)
+        self.output_text.grid(row=last_row + 4, columnspan=2)
+        # Other logs go through the same events as the conversion logs
+        logging.getLogger().addHandler(EventBusHandler(self.events))
 
-        handler = TextHandler(output_text)
-        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-        logging.getLogger().addHandler(handler)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.root.after(self.POLL_MS, self.poll)
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = EasyChartGeneratorApp(root)
     # Add args from CLI to GUI